@@ -0,0 +1,84 @@
+import hashlib
+import json
+import platform
+import re
+import subprocess
+import time
+
+import numpy as np
+from faq_common.normalize import normalize_text
+from langchain_core.embeddings import Embeddings
+
+# Helpers shared by the pipeline, retrieval and load-test benchmarks
+
+token_pattern = re.compile(r'\w+')
+
+
+class HashEmbeddings(Embeddings):
+    # Deterministic stand-in for the sentence encoder: every token is hashed to a signed dimension. Runs anywhere
+    # in milliseconds, so the index and retrieval code can be timed without the model dominating.
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f'hash-{dim}'
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+
+        for token in token_pattern.findall(normalize_text(text).lower()):
+            digest = int(hashlib.md5(token.encode('utf-8')).hexdigest(), 16)
+            vector[digest % self.dim] += 1 if digest & (1 << 64) else -1
+
+        return (vector / max(np.linalg.norm(vector), 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def best_of(repeat, function, *args):
+    # best wall time of `repeat` runs and the last result
+    best = None
+    result = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best, result
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {f'p{point}': None for point in points}
+
+    return {f'p{point}': float(np.percentile(values, point)) for point in points}
+
+
+def environment():
+    # what a result file was measured on, to compare runs between versions
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def report(results, output=None):
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2, ensure_ascii=False)
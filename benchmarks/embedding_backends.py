@@ -0,0 +1,86 @@
+import argparse
+from itertools import islice
+
+import numpy as np
+from faq_common.encoders import load_encoder
+from faq_common.jsonl import read_records
+
+from common import best_of, environment, report
+
+MODEL_NAME = 'paraphrase-multilingual-mpnet-base-v2'
+
+# Encodes the FAQ set with the fp32 model and the int8 ONNX model on CPU, then compares throughput and how far the
+# int8 vectors and rankings drift from the fp32 ones. Run from the repository root:
+#     python benchmarks/embedding_backends.py --limit 500 --output embedding_backends.json
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def encode(model, texts, batch_size, repeat):
+    seconds, vectors = best_of(repeat, lambda: model.encode(texts, batch_size=batch_size))
+
+    return normalize(np.asarray(vectors, dtype=np.float32)), {
+        'texts': len(texts),
+        'seconds': seconds,
+        'texts_per_sec': len(texts) / seconds,
+    }
+
+
+def top_k(queries, docs, k):
+    return np.argsort(-(queries @ docs.T), axis=1)[:, :k]
+
+
+parser = argparse.ArgumentParser(description="Compare fp32 and int8 embedding backends on the FAQ set")
+parser.add_argument('--faqs', default='unique_faqs.jsonl')
+parser.add_argument('--limit', type=int, default=500, help="FAQs to use, 0 for all")
+parser.add_argument('--k', type=int, default=5)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--threads', type=int, default=None)
+parser.add_argument('--repeat', type=int, default=1, help="times each set is encoded, the fastest counts")
+parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+args = parser.parse_args()
+
+faqs = list(islice(read_records(args.faqs), args.limit or None))
+
+questions = [faq['question'] for faq in faqs]
+docs = [' '.join([faq['question']] + [answer['answer_text'] for answer in faq['answers']]) for faq in faqs]
+
+results = {
+    'benchmark': 'embedding_backends',
+    'environment': environment(),
+    'model': MODEL_NAME,
+    'faqs': len(faqs),
+    'k': args.k,
+    'backends': {},
+}
+vectors = {}
+
+for backend in ['torch', 'onnx-int8']:
+    model, _ = load_encoder(MODEL_NAME, backend, 'cpu', args.threads)
+    model.encode(questions[:args.batch_size], batch_size=args.batch_size)  # warm-up
+
+    doc_vectors, doc_timing = encode(model, docs, args.batch_size, args.repeat)
+    query_vectors, query_timing = encode(model, questions, args.batch_size, args.repeat)
+
+    vectors[backend] = doc_vectors, query_vectors
+    results['backends'][backend] = {'documents': doc_timing, 'queries': query_timing}
+
+reference_docs, reference_queries = vectors['torch']
+int8_docs, int8_queries = vectors['onnx-int8']
+
+cosine = np.sum(reference_docs * int8_docs, axis=1)
+reference_top = top_k(reference_queries, reference_docs, args.k)
+int8_top = top_k(int8_queries, int8_docs, args.k)
+
+results['drift'] = {
+    'mean_cosine_to_fp32': float(cosine.mean()),
+    'min_cosine_to_fp32': float(cosine.min()),
+    'overlap_at_k': float(np.mean([len(set(a) & set(b)) / args.k for a, b in zip(reference_top, int8_top)])),
+    'top1_agreement': float(np.mean(reference_top[:, 0] == int8_top[:, 0])),
+}
+results['speedup'] = (results['backends']['onnx-int8']['documents']['texts_per_sec']
+                      / results['backends']['torch']['documents']['texts_per_sec'])
+
+report(results, args.output)
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+from faq_common.jsonl import read_records
+
+from common import environment, percentiles, report
+
+# Load test of the streaming endpoint at increasing concurrency. The LLM is replaced by app.ollama_stub servers with a
+# fixed time per token, so the numbers measure the app: admission, retrieval, prompt and streaming. Every level runs
+# a closed loop of `concurrency` clients, each sending its next FAQ question as soon as the previous answer ends.
+# The saturation point is the first level whose throughput is less than --saturation-gain above the one before.
+# Unless --url is given, the app is started with uvicorn against the stubs, with the answer cache turned off;
+# it opens the index in INDEX_DIR like in production. Run from the repository root:
+#     PYTHONPATH=.:mj-app python benchmarks/load_test.py --output load.json
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mj-app')
+
+
+def start_stubs(count, first_port, model, tokens, prompt_ms, token_ms, parallel):
+    # in their own processes, so they do not share the GIL with the load generator
+    processes = []
+
+    for port in range(first_port, first_port + count):
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'app.ollama_stub', '--port', str(port), '--model', model, '--tokens', str(tokens),
+             '--prompt-ms', str(prompt_ms), '--token-ms', str(token_ms), '--parallel', str(parallel)], cwd=APP_DIR))
+
+    return processes, [f'http://127.0.0.1:{port}' for port in range(first_port, first_port + count)]
+
+
+def start_app(port, stub_urls, model, coalesce):
+    env = dict(
+        os.environ,
+        OLLAMA_BASE_URLS=','.join(stub_urls),
+        OLLAMA_MODEL=model,
+        LLM_COALESCE='1' if coalesce else '0',
+        # similarities never reach 2, so every request goes to the LLM
+        ANSWER_CACHE_THRESHOLD='2',
+    )
+
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.server:app', '--port', str(port)], cwd=APP_DIR,
+                            env=env)
+
+
+def wait_until_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"the app exited with code {process.returncode}")
+
+        try:
+            if httpx.get(f'{url}/index/stats', timeout=5).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+
+        time.sleep(1)
+
+    raise TimeoutError(f"the app at {url} was not ready after {timeout} seconds")
+
+
+async def ask(client, query):
+    # one streamed answer: status, time to the first token event, total time and the app's own timings
+    start = time.perf_counter()
+    result = {'status': None, 'ttft_ms': None, 'total_ms': None, 'end': None}
+
+    try:
+        async with client.stream('GET', '/doctor_yab/sse', params={'query': query}) as response:
+            result['status'] = response.status_code
+            event = None
+
+            async for line in response.aiter_lines():
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+
+                    if event == 'token' and result['ttft_ms'] is None:
+                        result['ttft_ms'] = (time.perf_counter() - start) * 1000
+                elif line.startswith('data: ') and event == 'end':
+                    result['end'] = json.loads(line[len('data: '):])
+    except httpx.HTTPError as e:
+        result['status'] = type(e).__name__
+
+    result['total_ms'] = (time.perf_counter() - start) * 1000
+
+    return result
+
+
+async def run_level(url, queries, concurrency, duration, timeout):
+    results = []
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def worker(offset):
+            i = offset
+
+            while time.perf_counter() < deadline:
+                results.append(await ask(client, queries[i % len(queries)]))
+                i += concurrency
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+    ok = []
+    errors = {}
+
+    for result in results:
+        if result['status'] == 200 and result['end'] is not None:
+            ok.append(result)
+        else:
+            status = str(result['status'])
+            errors[status] = errors.get(status, 0) + 1
+
+    # as measured by the app, answers from its cache are not retrieved
+    retrieval = [result['end']['retrieval_ms'] for result in ok if 'retrieval_ms' in result['end']]
+
+    return {
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': errors,
+        'throughput_rps': len(ok) / seconds,
+        'latency_ms': percentiles([result['total_ms'] for result in ok]),
+        'ttft_ms': percentiles([result['ttft_ms'] for result in ok if result['ttft_ms'] is not None]),
+        'retrieval_ms': percentiles(retrieval),
+    }
+
+
+def saturation(levels, gain):
+    # first level where adding clients stops adding throughput, and first level with failed requests
+    saturated = None
+
+    for previous, level in zip(levels, levels[1:]):
+        if level['throughput_rps'] < previous['throughput_rps'] * (1 + gain):
+            saturated = previous['concurrency']
+            break
+
+    failing = next((level['concurrency'] for level in levels if level['errors']), None)
+
+    return {'saturated_at': saturated, 'first_errors_at': failing}
+
+
+parser = argparse.ArgumentParser(description="Load test of /doctor_yab/sse with a stub LLM")
+parser.add_argument('--faqs', default='unique_faqs.jsonl', help="questions sent as queries")
+parser.add_argument('--url', default=None, help="test an app already running here instead of starting one")
+parser.add_argument('--port', type=int, default=8100, help="port of the started app")
+parser.add_argument('--concurrency', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32, 64])
+parser.add_argument('--duration', type=float, default=20, help="seconds per concurrency level")
+parser.add_argument('--timeout', type=float, default=120, help="client timeout per request")
+parser.add_argument('--saturation-gain', type=float, default=0.1)
+parser.add_argument('--stubs', type=int, default=2, help="stub LLM servers")
+parser.add_argument('--stub-port', type=int, default=11500, help="port of the first stub")
+parser.add_argument('--model', default='llama3.1')
+parser.add_argument('--tokens', type=int, default=32, help="tokens per stub answer")
+parser.add_argument('--prompt-ms', type=float, default=50.0)
+parser.add_argument('--token-ms', type=float, default=10.0)
+parser.add_argument('--parallel', type=int, default=4, help="generations each stub runs at once")
+parser.add_argument('--no-coalesce', action='store_true', help="start the app with LLM_COALESCE=0")
+parser.add_argument('--startup-timeout', type=float, default=600, help="seconds to wait for the index to load")
+parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+args = parser.parse_args()
+
+queries = [faq['question'] for faq in read_records(args.faqs)]
+random.Random(0).shuffle(queries)
+
+processes = []
+process = None
+url = args.url
+
+if url is None:
+    processes, stub_urls = start_stubs(args.stubs, args.stub_port, args.model, args.tokens, args.prompt_ms,
+                                       args.token_ms, args.parallel)
+    process = start_app(args.port, stub_urls, args.model, not args.no_coalesce)
+    processes.append(process)
+    url = f'http://127.0.0.1:{args.port}'
+
+results = {
+    'benchmark': 'load_test',
+    'environment': environment(),
+    'url': url,
+    'stub': None if args.url else {
+        'servers': args.stubs,
+        'tokens': args.tokens,
+        'prompt_ms': args.prompt_ms,
+        'token_ms': args.token_ms,
+        'parallel': args.parallel,
+        'coalesce': not args.no_coalesce,
+    },
+    'levels': [],
+}
+
+try:
+    wait_until_ready(url, process, args.startup_timeout)
+
+    for concurrency in args.concurrency:
+        level = asyncio.run(run_level(url, queries, concurrency, args.duration, args.timeout))
+        results['levels'].append(level)
+        print(f"concurrency {concurrency}: {level['throughput_rps']:.1f} req/s, "
+              f"p95 {level['latency_ms']['p95']} ms, errors {level['errors']}", file=sys.stderr)
+
+    results.update(saturation(results['levels'], args.saturation_gain))
+finally:
+    for child in processes:
+        child.terminate()
+        child.wait()
+
+report(results, args.output)
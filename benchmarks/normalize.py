@@ -0,0 +1,57 @@
+import argparse
+
+from faq_common.jsonl import read_records
+from faq_common.normalize import clean_batch, clean_persian_text, normalize_batch, translation_table
+
+from common import best_of, environment, report
+
+# Times Persian normalization on the FAQ texts: the former str.translate implementation, the precompiled character
+# class behind clean_persian_text, and the batch APIs over whole columns. Crawled text is mostly clean already, so
+# a second run uses a copy typed with an Arabic keyboard (ي/ك). Run from the repository root:
+#     python benchmarks/normalize.py --output normalize.json
+
+
+def run(texts, repeat):
+    chars = sum(len(text) for text in texts)
+    functions = {
+        'translate': lambda items: [text.translate(translation_table) for text in items],
+        'clean_persian_text': lambda items: [clean_persian_text(text) for text in items],
+        'clean_batch': clean_batch,
+        'normalize_batch': normalize_batch,
+    }
+    timings = {name: best_of(repeat, function, texts)[0] for name, function in functions.items()}
+
+    return {
+        'texts': len(texts),
+        'chars': chars,
+        'identical_to_translate': clean_batch(texts) == [text.translate(translation_table) for text in texts],
+        'mb_per_sec': {name: chars / seconds / 1e6 for name, seconds in timings.items()},
+        'speedup_over_translate': {name: timings['translate'] / seconds for name, seconds in timings.items()},
+    }
+
+
+parser = argparse.ArgumentParser(description="Benchmark Persian text normalization")
+parser.add_argument('--faqs', default='unique_faqs.jsonl')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+args = parser.parse_args()
+
+columns = {'question': [], 'answer_text': [], 'dr_name': [], 'dr_exp': []}
+
+for faq in read_records(args.faqs):
+    columns['question'].append(faq['question'])
+
+    for answer in faq['answers']:
+        for field in ('answer_text', 'dr_name', 'dr_exp'):
+            columns[field].append(answer[field])
+
+dirty = str.maketrans({'ی': 'ي', 'ک': 'ك'})
+
+results = {
+    'benchmark': 'normalize',
+    'environment': environment(),
+    'columns': {field: run(texts, args.repeat) for field, texts in columns.items()},
+    'dirty_answer_text': run([text.translate(dirty) for text in columns['answer_text']], args.repeat),
+}
+
+report(results, args.output)
@@ -0,0 +1,146 @@
+import argparse
+import shutil
+import tempfile
+
+import numpy as np
+from faq_common.jsonl import read_records
+from faq_common.normalize import clean_batch, clean_persian_text
+
+from app.index import build_index, child_splitter, convert_to_documents
+from common import HashEmbeddings, best_of, environment, report
+from dedup import cluster, dedup_faqs, similar_pairs
+
+# Microbenchmarks of the offline pipeline: Persian normalization, the near-duplicate search and clustering of
+# prepare_docs.py, converting FAQs to answer documents, splitting them into chunks and building the index. The index
+# is built with HashEmbeddings unless --model is given, so the index code is timed rather than the encoder. Run from
+# the repository root:
+#     PYTHONPATH=.:mj-app python benchmarks/pipeline.py --output pipeline.json
+
+
+def synthetic_questions(size, dim, duplicate_share, seed=0):
+    # unit vectors where duplicate_share of the rows are slight perturbations of an earlier row
+    generator = np.random.default_rng(seed)
+    vectors = generator.standard_normal((size, dim)).astype(np.float32)
+    duplicates = generator.random(size) < duplicate_share
+    duplicates[0] = False
+
+    for row in np.flatnonzero(duplicates):
+        vectors[row] = vectors[generator.integers(row)] + 0.1 * generator.standard_normal(dim)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True), int(duplicates.sum())
+
+
+def bench_normalization(faqs, repeat):
+    texts = [answer['answer_text'] for faq in faqs for answer in faq['answers']]
+    chars = sum(len(text) for text in texts)
+    per_text, _ = best_of(repeat, lambda: [clean_persian_text(text) for text in texts])
+    batch, _ = best_of(repeat, clean_batch, texts)
+
+    return {
+        'texts': len(texts),
+        'chars': chars,
+        'clean_persian_text_mb_per_sec': chars / per_text / 1e6,
+        'clean_batch_mb_per_sec': chars / batch / 1e6,
+    }
+
+
+def bench_dedup(chats, sizes, dim, threshold, block_size, repeat):
+    embeddings = HashEmbeddings()
+    vectors = np.asarray(embeddings.embed_documents([chat['question'] for chat in chats]), dtype=np.float32)
+
+    def run(vectors):
+        return cluster(len(vectors), similar_pairs(vectors, threshold=threshold, block_size=block_size))
+
+    seconds, clusters = best_of(repeat, run, vectors)
+    merge_seconds, unique = best_of(repeat, lambda: list(dedup_faqs(chats, clusters)))
+
+    results = {
+        'chats': {
+            'questions': len(chats),
+            'clusters': len(clusters),
+            'pairs_and_clusters_ms': seconds * 1000,
+            'merge_ms': merge_seconds * 1000,
+            'unique_faqs': len(unique),
+        },
+        'scaling': [],
+    }
+
+    # all-pairs cost grows with the square of the number of questions
+    for size in sizes:
+        vectors, planted = synthetic_questions(size, dim, 0.1)
+        seconds, clusters = best_of(1, run, vectors)
+        results['scaling'].append({
+            'questions': size,
+            'planted_duplicates': planted,
+            'merged': size - len(clusters),
+            'seconds': seconds,
+            'questions_per_sec': size / seconds,
+        })
+
+    return results
+
+
+def bench_documents(faqs, repeat):
+    convert_seconds, (ids, docs) = best_of(repeat, convert_to_documents, faqs)
+    split_seconds, chunks = best_of(repeat, child_splitter.split_documents, docs)
+
+    return {
+        'faqs': len(faqs),
+        'answers': len(docs),
+        'chunks': len(chunks),
+        'convert_ms': convert_seconds * 1000,
+        'convert_answers_per_sec': len(docs) / convert_seconds,
+        'split_ms': split_seconds * 1000,
+        'split_answers_per_sec': len(docs) / split_seconds,
+    }
+
+
+def bench_index(faq_path, backends, embeddings):
+    results = {}
+
+    for backend in backends:
+        index_dir = tempfile.mkdtemp(prefix='bench-index-')
+
+        try:
+            seconds, _ = best_of(1, build_index, faq_path, index_dir, embeddings, backend)
+            results[backend] = {'seconds': seconds}
+        finally:
+            shutil.rmtree(index_dir)
+
+    return results
+
+
+parser = argparse.ArgumentParser(description="Microbenchmarks of the offline FAQ pipeline")
+parser.add_argument('--faqs', default='unique_faqs.jsonl')
+parser.add_argument('--chats', default='scrape_chats/chats.jsonl')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--dedup-sizes', type=int, nargs='*', default=[1000, 5000, 20000],
+                    help="synthetic question counts for the all-pairs search")
+parser.add_argument('--dim', type=int, default=768, help="dimension of the synthetic question vectors")
+parser.add_argument('--threshold', type=float, default=0.85)
+parser.add_argument('--block-size', type=int, default=1024)
+parser.add_argument('--backends', nargs='*', default=['chroma', 'mmap'], help="index backends to build")
+parser.add_argument('--model', action='store_true', help="build the index with the real encoder and its cache")
+parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+args = parser.parse_args()
+
+faqs = list(read_records(args.faqs))
+chats = list(read_records(args.chats))
+
+if args.model:
+    from app.embeddings import load_embeddings
+
+    embeddings = load_embeddings()
+else:
+    embeddings = HashEmbeddings()
+
+results = {
+    'benchmark': 'pipeline',
+    'environment': environment(),
+    'normalization': bench_normalization(faqs, args.repeat),
+    'dedup': bench_dedup(chats, args.dedup_sizes, args.dim, args.threshold, args.block_size, args.repeat),
+    'documents': bench_documents(faqs, args.repeat),
+    'index_build': {'embeddings': embeddings.name, 'backends': bench_index(args.faqs, args.backends, embeddings)},
+}
+
+report(results, args.output)
@@ -0,0 +1,110 @@
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from faq_common.jsonl import read_records
+
+from app.index import build_index, open_retriever, stable_id
+from common import HashEmbeddings, environment, percentiles, report
+
+# Recall@k and throughput of the retriever on the FAQ set, for every index backend and retrieval mode. Each sampled
+# FAQ question is a query whose right answer is its own FAQ. A second query set drops every third word, so that
+# recall does not only reward exact matches. Uses HashEmbeddings unless --model is given. Run from the repository
+# root:
+#     PYTHONPATH=.:mj-app python benchmarks/retrieval.py --output retrieval.json
+#     PYTHONPATH=.:mj-app python benchmarks/retrieval.py --model --backends mmap
+
+
+def drop_words(question, every=3):
+    words = question.split()
+
+    return ' '.join(word for i, word in enumerate(words) if i % every != every - 1) or question
+
+
+def evaluate(retriever, queries, targets, ks):
+    latencies = []
+    hits = {k: 0 for k in ks}
+
+    for query, target in zip(queries, targets):
+        start = time.perf_counter()
+        ranked = [doc.metadata['faq_id'] for doc in retriever.invoke(query)]
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        for k in ks:
+            hits[k] += target in ranked[:k]
+
+    return {
+        'recall_at_k': {str(k): hits[k] / len(queries) for k in ks},
+        'latency_ms': percentiles(latencies),
+    }
+
+
+def throughput(retriever, queries, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(retriever.invoke, queries))
+        seconds = time.perf_counter() - start
+
+    return {'concurrency': concurrency, 'queries': len(queries), 'qps': len(queries) / seconds}
+
+
+parser = argparse.ArgumentParser(description="Retrieval recall@k and QPS on the FAQ set")
+parser.add_argument('--faqs', default='unique_faqs.jsonl')
+parser.add_argument('--index-dir', default=None, help="keep the built indexes here instead of a temporary folder")
+parser.add_argument('--backends', nargs='*', default=['chroma', 'mmap'])
+parser.add_argument('--modes', nargs='*', default=['hybrid', 'vector'])
+parser.add_argument('--queries', type=int, default=500, help="FAQ questions sampled as queries, 0 for all")
+parser.add_argument('--k', type=int, nargs='*', default=[1, 3])
+parser.add_argument('--concurrency', type=int, nargs='*', default=[1, 4, 8])
+parser.add_argument('--model', action='store_true', help="use the real encoder and its cache")
+parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+args = parser.parse_args()
+
+questions = [faq['question'] for faq in read_records(args.faqs)]
+
+if args.queries:
+    questions = random.Random(0).sample(questions, min(args.queries, len(questions)))
+
+targets = [stable_id(question) for question in questions]
+query_sets = {'question': questions, 'dropped_words': [drop_words(question) for question in questions]}
+
+if args.model:
+    from app.embeddings import load_embeddings
+
+    embeddings = load_embeddings()
+else:
+    embeddings = HashEmbeddings()
+
+index_dir = args.index_dir or tempfile.mkdtemp(prefix='bench-index-')
+results = {
+    'benchmark': 'retrieval',
+    'environment': environment(),
+    'embeddings': embeddings.name,
+    'queries': len(questions),
+    'runs': [],
+}
+
+try:
+    for backend in args.backends:
+        start = time.perf_counter()
+        path = build_index(args.faqs, index_dir, embeddings, backend)
+        build_seconds = time.perf_counter() - start
+
+        for mode in args.modes:
+            retriever = open_retriever(path, embeddings, backend, mode=mode)
+            run = {'backend': backend, 'mode': mode, 'build_seconds': build_seconds}
+
+            # the first pass also warms the query embedding cache, throughput is then measured without the encoder
+            for name, queries in query_sets.items():
+                run[name] = evaluate(retriever, queries, targets, args.k)
+
+            run['throughput'] = [throughput(retriever, questions, concurrency) for concurrency in args.concurrency]
+            results['runs'].append(run)
+finally:
+    if args.index_dir is None:
+        shutil.rmtree(index_dir)
+
+report(results, args.output)
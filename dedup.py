@@ -0,0 +1,349 @@
+import hashlib
+import json
+from collections import Counter
+
+import torch
+from tqdm.autonotebook import tqdm
+
+
+class UnionFind:
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            # path halving keeps the trees flat without recursion
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+
+        return x
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+
+        if root_a == root_b:
+            return
+
+        # the smaller index always wins, so the root of a cluster is its first-seen question
+        if root_a < root_b:
+            self.parent[root_b] = root_a
+        else:
+            self.parent[root_a] = root_b
+
+
+def similar_pairs(embeddings, threshold=0.85, block_size=1024, show_progress=False):
+    # Yields every (i, j), i < j, whose cosine similarity is above the threshold.
+    # Similarities are computed tile by tile, so at most block_size x block_size scores live in memory.
+    embeddings = torch.nn.functional.normalize(torch.as_tensor(embeddings), dim=1)
+    size = len(embeddings)
+
+    for row in tqdm(range(0, size, block_size), disable=not show_progress):
+        rows = embeddings[row:row + block_size]
+
+        for col in range(row, size, block_size):
+            mask = rows @ embeddings[col:col + block_size].T > threshold
+
+            if col == row:
+                mask = mask.triu(diagonal=1)
+
+            i, j = torch.nonzero(mask, as_tuple=True)
+
+            yield from zip((i + row).tolist(), (j + col).tolist())
+
+
+def ann_neighbours(embeddings, threshold=0.85, top_k=32, ef=64, m=16, num_threads=-1):
+    # Approximate variant of similar_pairs: an HNSW graph proposes top_k candidates per question
+    # and only those are checked against the threshold. Returns the neighbour ids of every row.
+    try:
+        import hnswlib
+    except ImportError:
+        raise ImportError("the ann backend needs hnswlib, install it with `pip install hnswlib`")
+
+    vectors = torch.nn.functional.normalize(torch.as_tensor(embeddings), dim=1).cpu().numpy()
+    size, dim = vectors.shape
+    top_k = min(top_k + 1, size)
+
+    index = hnswlib.Index(space='cosine', dim=dim)
+    index.init_index(max_elements=size, ef_construction=max(ef, top_k), M=m)
+    index.add_items(vectors, num_threads=num_threads)
+    index.set_ef(max(ef, top_k))
+
+    labels, distances = index.knn_query(vectors, k=top_k, num_threads=num_threads)
+
+    neighbours = []
+
+    for i, (row_labels, row_distances) in enumerate(zip(labels, distances)):
+        # hnswlib reports cosine distance, i.e. 1 - similarity
+        neighbours.append([j for j, d in zip(row_labels.tolist(), row_distances.tolist())
+                           if j != i and 1 - d > threshold])
+
+    return neighbours
+
+
+def neighbour_pairs(neighbours):
+    for i, row in enumerate(neighbours):
+        for j in row:
+            yield min(i, j), max(i, j)
+
+
+def neighbour_recall(embeddings, neighbours, threshold=0.85, sample_size=1000, block_size=1024, seed=0):
+    # Share of the exact above-threshold neighbours of a random sample of rows that the ANN path also found.
+    # Scores are computed tile by tile like in similar_pairs, block_size x block_size at a time.
+    embeddings = torch.nn.functional.normalize(torch.as_tensor(embeddings), dim=1)
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randperm(len(embeddings), generator=generator)[:sample_size]
+
+    found = total = 0
+
+    for start in range(0, len(sample), block_size):
+        ids = sample[start:start + block_size]
+        rows = embeddings[ids]
+        exact = [set() for _ in ids]
+
+        for col in range(0, len(embeddings), block_size):
+            i, j = torch.nonzero(rows @ embeddings[col:col + block_size].T > threshold, as_tuple=True)
+
+            for row, neighbour in zip(i.tolist(), (j + col).tolist()):
+                exact[row].add(neighbour)
+
+        for row_exact, i in zip(exact, ids.tolist()):
+            row_exact.discard(i)
+            found += len(row_exact & set(neighbours[i]))
+            total += len(row_exact)
+
+    return found / total if total else 1.0
+
+
+def cluster(size, pairs):
+    union_find = UnionFind(size)
+
+    for i, j in pairs:
+        union_find.union(i, j)
+
+    clusters = {}
+
+    for i in range(size):
+        clusters.setdefault(union_find.find(i), []).append(i)
+
+    # dicts keep insertion order, so clusters come out sorted by their base index
+    return list(clusters.values())
+
+
+def merge_faq(base_faq, similars):
+    merged = dict(base_faq, answers=list(base_faq['answers']))
+
+    for ans in [a for f in similars for a in f['answers']]:
+        merged['answers'].append(ans)
+
+    return merged
+
+
+def dedup_faqs(faqs, clusters):
+    # Yields one FAQ per cluster, so only one cluster is held in memory at a time when faqs is read lazily
+    for ids in clusters:
+        if len(ids) > 1:
+            yield merge_faq(faqs[ids[0]], [faqs[j] for j in ids[1:]])
+        else:
+            yield faqs[ids[0]]
+
+
+def short_hash(data):
+    return hashlib.sha1(json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def chat_key(chat):
+    # crawls record the chat's page, older chat files only have the question to tell chats apart
+    return chat.get('url') or chat['question']
+
+
+def answer_key(answer):
+    return short_hash([answer['dr_name'], answer['answer_text']])
+
+
+def chat_summary(chat):
+    # what the state keeps of a chat: which one it is, which version of it and the answers it added to its FAQ
+    return {
+        'key': chat_key(chat),
+        'version': short_hash([chat['question'], chat['answers']]),
+        'question': chat['question'],
+        'answers': [answer_key(answer) for answer in chat['answers']],
+    }
+
+
+# labels of the state rows of chats that are not in any FAQ: replaced by a newer version, or without answers
+REPLACED = -1
+NO_FAQ = -2
+
+
+def answered(faqs, clusters):
+    # FAQs without answers are not written, chats in clusters of answerless chats are in no FAQ
+    return [ids for ids in clusters if any(faqs[i]['answers'] for i in ids)]
+
+
+def build_state(model_name, chats, embeddings, clusters):
+    # Everything an incremental run needs from this one: the summary of every chat (see chat_summary), their
+    # embeddings, the FAQ each one ended up in and the running centroid of every FAQ.
+    embeddings = torch.nn.functional.normalize(torch.as_tensor(embeddings), dim=1).cpu()
+    labels = torch.full((len(chats),), NO_FAQ, dtype=torch.long)
+
+    for label, ids in enumerate(clusters):
+        labels[ids] = label
+
+    in_faq = labels >= 0
+
+    return {
+        'model': model_name,
+        'keys': [chat['key'] for chat in chats],
+        'versions': [chat['version'] for chat in chats],
+        'answers': [chat['answers'] for chat in chats],
+        'embeddings': embeddings,
+        'labels': labels,
+        'centroid_sums': torch.zeros(len(clusters), embeddings.shape[1]).index_add_(0, labels[in_faq],
+                                                                                   embeddings[in_faq]),
+    }
+
+
+def current_versions(state):
+    # the state row of every chat's current version
+    return {key: row for row, (key, label) in enumerate(zip(state['keys'], state['labels'].tolist()))
+            if label != REPLACED}
+
+
+def retract(unique_faqs, state, rows):
+    # Takes the chats at these state rows back out of their FAQs, before a new version of them is merged: their
+    # answers are removed and their questions stop counting towards the centroid. unique_faqs and state are updated
+    # in place; the indexes of the touched FAQs are returned.
+    changed = []
+
+    for row in rows:
+        label = int(state['labels'][row])
+        state['labels'][row] = REPLACED
+
+        if label < 0:
+            continue
+
+        stale = Counter(state['answers'][row])
+        answers = []
+
+        for answer in unique_faqs[label]['answers']:
+            key = answer_key(answer)
+
+            if stale[key] > 0:
+                stale[key] -= 1
+            else:
+                answers.append(answer)
+
+        unique_faqs[label] = dict(unique_faqs[label], answers=answers)
+        state['centroid_sums'][label] -= state['embeddings'][row]
+        changed.append(label)
+
+    return changed
+
+
+def best_matches(queries, keys, block_size=1024):
+    best_scores = torch.full((len(queries),), -1.0)
+    best_ids = torch.full((len(queries),), -1, dtype=torch.long)
+
+    for start in range(0, len(keys), block_size):
+        scores, ids = (queries @ keys[start:start + block_size].T).max(dim=1)
+        better = scores > best_scores
+        best_scores[better] = scores[better]
+        best_ids[better] = ids[better] + start
+
+    return best_scores, best_ids
+
+
+def merge_incremental(unique_faqs, state, faqs, embeddings, clusters, previous=None, threshold=0.85,
+                      block_size=1024):
+    # Attaches every cluster of new chats, or new versions of retracted ones, to the FAQ with the closest centroid,
+    # or appends it as a new FAQ. previous gives, for every chat, the FAQ its retracted version was in (or None):
+    # the cluster is tried against that FAQ first, and takes its place when no other chat is left in it.
+    # unique_faqs and state are updated in place; the indexes of the touched FAQs are returned.
+    embeddings = torch.nn.functional.normalize(torch.as_tensor(embeddings), dim=1).cpu()
+    labels = torch.empty(len(faqs), dtype=torch.long)
+    previous = previous or [None] * len(faqs)
+    changed = []
+
+    if clusters:
+        representatives = torch.stack([embeddings[ids].mean(dim=0) for ids in clusters])
+        representatives = torch.nn.functional.normalize(representatives, dim=1)
+        centroids = torch.nn.functional.normalize(state['centroid_sums'], dim=1)
+        scores, targets = best_matches(representatives, centroids, block_size)
+
+        current = state['labels'][state['labels'] >= 0]
+        members = torch.bincount(current, minlength=len(unique_faqs)).tolist()
+        # kept up to date as clusters land in the FAQs of their previous versions
+        sums = state['centroid_sums'].clone()
+
+        for ids, representative, score, target in zip(clusters, representatives, scores.tolist(), targets.tolist()):
+            similars = [faqs[j] for j in ids]
+            slots = list(dict.fromkeys(previous[j] for j in ids if previous[j] is not None and previous[j] >= 0))
+            slot = next((slot for slot in slots if members[slot] == 0), None)
+
+            if slot is not None:
+                # what is left of the old version is dropped, rounding leftovers included
+                target = slot
+                unique_faqs[target] = merge_faq(similars[0], similars[1:])
+                state['centroid_sums'][target] = sums[target] = 0
+            else:
+                slot = next((slot for slot in slots
+                             if representative @ torch.nn.functional.normalize(sums[slot], dim=0) > threshold), None)
+
+                if slot is not None or (target >= 0 and score > threshold):
+                    target = slot if slot is not None else target
+                    unique_faqs[target] = merge_faq(unique_faqs[target], similars)
+                else:
+                    target = len(unique_faqs)
+                    unique_faqs.append(merge_faq(similars[0], similars[1:]))
+                    members.append(0)
+                    sums = torch.cat([sums, torch.zeros(1, sums.shape[1])])
+
+            members[target] += len(ids)
+            sums[target] += embeddings[ids].sum(dim=0)
+            labels[ids] = target
+            changed.append(target)
+
+    sums = state['centroid_sums']
+    sums = torch.cat([sums, torch.zeros(len(unique_faqs) - len(sums), sums.shape[1])])
+
+    summaries = [chat_summary(faq) for faq in faqs]
+    state['keys'] += [chat['key'] for chat in summaries]
+    state['versions'] += [chat['version'] for chat in summaries]
+    state['answers'] += [chat['answers'] for chat in summaries]
+    state['embeddings'] = torch.cat([state['embeddings'], embeddings])
+    state['labels'] = torch.cat([state['labels'], labels])
+    state['centroid_sums'] = sums.index_add_(0, labels, embeddings)
+
+    return sorted(set(changed))
+
+
+def drop_empty(unique_faqs, state, changed):
+    # Leaves out the FAQs among `changed` that have no answers left, and renumbers the others in the state.
+    # Returns the indexes of the FAQs to write, and the new indexes of the changed ones.
+    empty = {label for label in changed if not unique_faqs[label]['answers']}
+    kept = [label for label in range(len(unique_faqs)) if label not in empty]
+
+    if not empty:
+        return kept, changed
+
+    new_labels = torch.full((len(unique_faqs),), NO_FAQ, dtype=torch.long)
+    new_labels[kept] = torch.arange(len(kept))
+    in_faq = state['labels'] >= 0
+    state['labels'][in_faq] = new_labels[state['labels'][in_faq]]
+    state['centroid_sums'] = state['centroid_sums'][kept]
+
+    return kept, [int(new_labels[label]) for label in changed if label not in empty]
+
+
+def update_faqs(unique_faqs, state, current, faqs, embeddings, clusters, threshold=0.85, block_size=1024):
+    # One incremental run: chats that changed since `current` (see current_versions) are retracted, then the new
+    # and changed chats are merged. Returns what drop_empty does.
+    rows = [current.get(chat_key(faq)) for faq in faqs]
+    previous = [None if row is None else int(state['labels'][row]) for row in rows]
+
+    changed = retract(unique_faqs, state, [row for row in rows if row is not None])
+    changed += merge_incremental(unique_faqs, state, faqs, embeddings, clusters, previous=previous,
+                                 threshold=threshold, block_size=block_size)
+
+    return drop_empty(unique_faqs, state, sorted(set(changed)))
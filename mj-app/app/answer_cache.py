@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+
+from app.filters import scope_key, split_request
+from app.metrics import CACHE_LOOKUPS
+
+
+class SemanticCache:
+    # Answers keyed on the query embedding: a query whose cosine similarity to a cached one reaches the threshold
+    # gets the cached answer. Entries expire after ttl seconds, the least recently used one is evicted when full,
+    # and everything is dropped when the source file (unique_faqs.jsonl) changes on disk. Answers restricted to a
+    # specialty or doctor only match queries with the same scope.
+
+    def __init__(self, threshold=0.95, max_size=1024, ttl=3600, source=None, clock=time.monotonic):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.source = source
+        self.clock = clock
+
+        self.vectors = None
+        self.valid = np.zeros(max_size, dtype=bool)
+        self.scopes = np.full(max_size, '', dtype=object)
+        self.entries = OrderedDict()  # slot -> (answer, expiry), oldest use first
+        self.free = list(range(max_size))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._source_stamp = self._stamp()
+        self._lock = threading.Lock()
+
+    def _stamp(self):
+        if self.source is None or not os.path.exists(self.source):
+            return None
+
+        stat = os.stat(self.source)
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def _drop(self, slot):
+        del self.entries[slot]
+        self.valid[slot] = False
+        self.free.append(slot)
+
+    def _clear(self):
+        for slot in list(self.entries):
+            self._drop(slot)
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def _check_source(self):
+        stamp = self._stamp()
+
+        if stamp != self._source_stamp:
+            self._source_stamp = stamp
+            self._clear()
+            self.invalidations += 1
+
+    def lookup(self, vector, scope=''):
+        answer = self._lookup(vector, scope)
+        CACHE_LOOKUPS.inc(result='miss' if answer is None else 'hit')
+
+        return answer
+
+    def _lookup(self, vector, scope):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+
+        with self._lock:
+            self._check_source()
+
+            if not self.entries:
+                self.misses += 1
+                return None
+
+            scores = np.where(self.valid & (self.scopes == scope), self.vectors @ vector, -np.inf)
+            slot = int(np.argmax(scores))
+
+            if scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+
+            answer, expiry = self.entries[slot]
+
+            if expiry <= self.clock():
+                self._drop(slot)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(slot)
+            self.hits += 1
+
+            return answer
+
+    def put(self, vector, answer, scope=''):
+        if self.max_size <= 0:
+            return
+
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, len(vector)), dtype=np.float32)
+
+            if not self.free:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+            slot = self.free.pop()
+            self.vectors[slot] = vector
+            self.valid[slot] = True
+            self.scopes[slot] = scope
+            self.entries[slot] = (answer, self.clock() + self.ttl)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self.entries),
+            'max_size': self.max_size,
+        }
+
+
+def with_semantic_cache(chain, embeddings, cache):
+    # Wraps a request -> str chain (see split_request); any runnable works, so a fake LLM can stand in for Ollama
+    def answer(request: Union[str, dict]) -> str:
+        query, hints = split_request(request)
+        vector = embeddings.embed_query(query)
+        cached = cache.lookup(vector, scope_key(hints))
+
+        if cached is not None:
+            return cached
+
+        result = chain.invoke(request)
+        cache.put(vector, result, scope_key(hints))
+
+        return result
+
+    async def aanswer(request: Union[str, dict]) -> str:
+        query, hints = split_request(request)
+        vector = await embeddings.aembed_query(query)
+        cached = cache.lookup(vector, scope_key(hints))
+
+        if cached is not None:
+            return cached
+
+        result = await chain.ainvoke(request)
+        cache.put(vector, result, scope_key(hints))
+
+        return result
+
+    return RunnableLambda(answer, afunc=aanswer)
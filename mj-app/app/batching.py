@@ -0,0 +1,83 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+class QueryBatcher:
+    # Collects queries from concurrent requests and encodes them in one forward pass. A batch is flushed when it
+    # reaches max_batch_size or max_wait seconds after its first query arrived, whichever comes first.
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait=0.005):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.batch_sizes = Counter()
+        self.batches = 0
+        self.queries = 0
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='query-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future))
+
+        return future
+
+    def embed_query(self, text):
+        return self.submit(text).result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            # callers that gave up (a timeout, a closed stream) cancelled their future: they are dropped, and the
+            # others can no longer be cancelled, so setting their result cannot fail and stop this thread
+            batch = [(text, future) for text, future in self._collect() if future.set_running_or_notify_cancel()]
+
+            if not batch:
+                continue
+
+            texts = [text for text, _ in batch]
+
+            try:
+                vectors = self.encode_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+            self.batch_sizes[len(batch)] += 1
+            self.batches += 1
+            self.queries += len(batch)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'queries': self.queries,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+        }
@@ -0,0 +1,114 @@
+import math
+import os
+import threading
+from typing import Any
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from app.lexical import tokenize
+from app.metrics import span
+
+# 0 disables compression
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.8))
+# llama3.1 has no tokenizer here, prompt size is estimated from the character count
+CONTEXT_CHARS_PER_TOKEN = float(os.environ.get('CONTEXT_CHARS_PER_TOKEN', 3))
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class ContextCompressor:
+    # Documents are `question\n\nanswer\n\nanswer...`. Every retrieved question is kept; answers that nearly
+    # repeat one already kept are dropped, and the rest are added by relevance to the query until the token
+    # budget is used up. Kept answers stay in their original order.
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD,
+                 chars_per_token=CONTEXT_CHARS_PER_TOKEN):
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.chars_per_token = chars_per_token
+
+        self.requests = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.duplicates_dropped = 0
+        self._lock = threading.Lock()
+
+    def count_tokens(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def compress(self, query, docs):
+        query_terms = set(tokenize(query))
+        questions = []
+        candidates = []
+        kept_terms = []
+        duplicates = 0
+        tokens_in = 0
+
+        for rank, doc in enumerate(docs):
+            question, *answers = doc.page_content.split('\n\n')
+            questions.append(question)
+            tokens_in += self.count_tokens(doc.page_content)
+
+            for position, answer in enumerate(answers):
+                terms = set(tokenize(answer))
+
+                if any(jaccard(terms, kept) >= self.duplicate_threshold for kept in kept_terms):
+                    duplicates += 1
+                    continue
+
+                kept_terms.append(terms)
+                relevance = len(terms & query_terms) / len(query_terms) if query_terms else 0
+                candidates.append((-relevance, rank, position, answer))
+
+        used = sum(self.count_tokens(question) for question in questions)
+        kept = [[] for _ in docs]
+
+        for _, rank, position, answer in sorted(candidates):
+            cost = self.count_tokens(answer)
+
+            if used + cost > self.token_budget:
+                continue
+
+            used += cost
+            kept[rank].append((position, answer))
+
+        compressed = []
+
+        for doc, question, answers in zip(docs, questions, kept):
+            content = '\n\n'.join([question] + [answer for _, answer in sorted(answers)])
+            compressed.append(Document(page_content=content, metadata=dict(
+                doc.metadata, tokens=self.count_tokens(content), tokens_original=self.count_tokens(doc.page_content))))
+
+        with self._lock:
+            self.requests += 1
+            self.tokens_in += tokens_in
+            self.tokens_out += sum(doc.metadata['tokens'] for doc in compressed)
+            self.duplicates_dropped += duplicates
+
+        return compressed
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'token_budget': self.token_budget,
+            'tokens_in': self.tokens_in,
+            'tokens_out': self.tokens_out,
+            'tokens_saved': self.tokens_in - self.tokens_out,
+            'duplicates_dropped': self.duplicates_dropped,
+        }
+
+
+class CompressingRetriever(BaseRetriever):
+
+    retriever: BaseRetriever
+    compressor: Any
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        docs = self.retriever.invoke(query, **kwargs)
+
+        with span('compress'):
+            return self.compressor.compress(query, docs)
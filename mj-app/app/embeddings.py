@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+
+from faq_common.embedding_cache import EmbeddingCache
+from faq_common.encoders import encoder_name, load_encoder
+from faq_common.normalize import normalize_text
+from langchain_core.embeddings import Embeddings
+
+from app.batching import QueryBatcher
+from app.metrics import span
+
+MODEL_NAME = 'paraphrase-multilingual-mpnet-base-v2'
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', '../.embedding_cache')
+# auto picks the int8 ONNX model on machines without a GPU, see faq_common.encoders
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'auto')
+EMBEDDING_DEVICE = os.environ.get('EMBEDDING_DEVICE', 'auto')
+EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS', 0)) or None
+QUERY_BATCH_SIZE = int(os.environ.get('QUERY_BATCH_SIZE', 32))
+QUERY_BATCH_WAIT_MS = float(os.environ.get('QUERY_BATCH_WAIT_MS', 5))
+
+
+class EncoderEmbeddings(Embeddings):
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def embed_documents(self, texts):
+        # same preprocessing as HuggingFaceEmbeddings, so vectors match the ones it produced
+        texts = [text.replace("\n", " ") for text in texts]
+
+        return self.encoder.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class CachedEmbeddings(Embeddings):
+    # Document embeddings go through the on-disk EmbeddingCache. Queries go to the model, through the batcher
+    # when there is one, with a small in-memory cache since the answer cache and the retriever embed the same
+    # query back to back. Like documents, queries are normalized first, so spelling variants share a vector.
+
+    def __init__(self, embeddings, cache, query_cache_size=1024, batcher=None):
+        self.name = cache.model_name
+        self.embeddings = embeddings
+        self.cache = cache
+        self.batcher = batcher
+        self.query_cache_size = query_cache_size
+
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recall(self, text):
+        with self._lock:
+            vector = self._queries.get(text)
+
+            if vector is not None:
+                self._queries.move_to_end(text)
+
+            return vector
+
+    def _remember(self, text, vector):
+        with self._lock:
+            self._queries[text] = tuple(vector)
+
+            if len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+
+    def embed_documents(self, texts):
+        return self.cache.encode(texts, self.embeddings.embed_documents).tolist()
+
+    def embed_query(self, text):
+        text = normalize_text(text)
+        vector = self._recall(text)
+
+        if vector is None:
+            with span('embed_query'):
+                if self.batcher is not None:
+                    vector = self.batcher.embed_query(text)
+                else:
+                    vector = self.embeddings.embed_query(text)
+
+            self._remember(text, vector)
+
+        return list(vector)
+
+    async def aembed_query(self, text):
+        # Waits on the batcher's future without holding a thread
+        text = normalize_text(text)
+        vector = self._recall(text)
+
+        if vector is None:
+            with span('embed_query'):
+                if self.batcher is not None:
+                    vector = await asyncio.wrap_future(self.batcher.submit(text))
+                else:
+                    vector = await asyncio.get_running_loop().run_in_executor(None, self.embeddings.embed_query, text)
+
+            self._remember(text, vector)
+
+        return list(vector)
+
+
+def load_embeddings():
+    encoder, backend = load_encoder(MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_DEVICE, EMBEDDING_THREADS)
+    model = EncoderEmbeddings(encoder)
+
+    batcher = None
+
+    if QUERY_BATCH_SIZE > 1:
+        batcher = QueryBatcher(model.embed_documents, max_batch_size=QUERY_BATCH_SIZE,
+                               max_wait=QUERY_BATCH_WAIT_MS / 1000)
+
+    # Chunks embedded by an earlier run or by another worker are read back from disk instead of re-encoded
+    cache = EmbeddingCache(EMBEDDING_CACHE_DIR, encoder_name(MODEL_NAME, backend))
+
+    return CachedEmbeddings(model, cache, batcher=batcher)
@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+from faq_common.normalize import normalize_text
+
+# Metadata a query can be restricted to. Filters are plain dicts mapping one of these keys to the accepted values,
+# e.g. {'dr_exp': ['متخصص قلب و عروق']}.
+FILTER_KEYS = ('dr_exp', 'dr_name')
+
+
+class MetadataColumns:
+    # One int32 code per row and key, so a filter becomes a vectorized membership test instead of a metadata scan
+
+    def __init__(self, values, codes):
+        self.values = values
+        self.codes = codes
+        self.lookup = {key: {value: code for code, value in enumerate(values[key])} for key in values}
+
+    @classmethod
+    def build(cls, metadatas, keys=FILTER_KEYS):
+        values = {}
+        codes = {}
+
+        for key in keys:
+            column = [metadata.get(key, '') for metadata in metadatas]
+            values[key] = sorted(set(column))
+            index = {value: code for code, value in enumerate(values[key])}
+            codes[key] = np.array([index[value] for value in column], dtype=np.int32)
+
+        return cls(values, codes)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, 'filters.json'), 'w') as fp:
+            json.dump(self.values, fp, ensure_ascii=False)
+
+        # one .npy per key, memory-mapped on load
+        for key, codes in self.codes.items():
+            np.save(os.path.join(path, f'filters-{key}.npy'), codes)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'filters.json')) as fp:
+            values = json.load(fp)
+
+        return cls(values, {key: np.load(os.path.join(path, f'filters-{key}.npy'), mmap_mode='r') for key in values})
+
+    def mask(self, filter, rows=slice(None)):
+        # Boolean mask over `rows` (all rows by default) of the rows matching every key of the filter
+        mask = None
+
+        for key, accepted in filter.items():
+            accepted_codes = [self.lookup[key][value] for value in accepted if value in self.lookup[key]]
+            key_mask = np.isin(self.codes[key][rows], accepted_codes)
+            mask = key_mask if mask is None else mask & key_mask
+
+        return mask
+
+    def resolve(self, key, hint):
+        # Values of `key` that contain the hint, compared after the usual Persian normalization
+        hint = normalize_text(hint)
+
+        return [value for value in self.values.get(key, []) if hint and hint in normalize_text(value)]
+
+
+def to_chroma_where(filter):
+    clauses = [{key: {'$in': list(values)}} for key, values in filter.items()]
+
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+
+def split_request(request):
+    # The chain takes the bare question, or {'query': ..., 'specialty': ..., 'doctor': ...} to narrow the answers
+    # down to matching doctors. Returns the normalized question and the hints given.
+    if isinstance(request, str):
+        return normalize_text(request), {}
+
+    return normalize_text(request['query']), {key: request[key] for key in ('specialty', 'doctor') if request.get(key)}
+
+
+def scope_key(hints):
+    return json.dumps(hints, ensure_ascii=False, sort_keys=True) if hints else ''
@@ -0,0 +1,359 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any
+
+from faq_common.jsonl import read_records
+from langchain.docstore.document import Document
+from langchain.retrievers import ParentDocumentRetriever
+from langchain_core.retrievers import BaseRetriever
+from langchain.storage import LocalFileStore, create_kv_docstore
+from langchain_chroma import Chroma
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from app.filters import MetadataColumns, to_chroma_where
+from app.lexical import BM25Index, HybridRetriever
+from app.metrics import span
+from app.mmap_store import MmapDocStore, MmapVectorStore
+
+# Bump whenever the on-disk layout or the way documents are split changes, old indexes are then rebuilt
+INDEX_VERSION = 6
+
+FAQ_PATH = os.environ.get('FAQ_PATH', '../unique_faqs.jsonl')
+INDEX_DIR = os.environ.get('INDEX_DIR', '../index')
+# chroma: a Chroma collection and a file-per-document docstore
+# mmap: flat memory-mapped files, shared by all workers through the page cache
+INDEX_BACKEND = os.environ.get('INDEX_BACKEND', 'chroma')
+COLLECTION_NAME = "full_documents"
+# hybrid: BM25 and dense hits fused by reciprocal rank, with a BM25-only fast path on strong keyword matches
+# vector: dense retrieval only
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+LEXICAL_FAST_PATH_MARGIN = float(os.environ.get('LEXICAL_FAST_PATH_MARGIN', 2.0))
+# Index directories kept under INDEX_DIR after a reload, the newest first. Several workers reload one after the
+# other, so the one before the current index is kept for those that have not swapped yet.
+INDEX_KEEP = int(os.environ.get('INDEX_KEEP', 2))
+
+logger = logging.getLogger(__name__)
+
+separators = [
+    "\n\n",
+    ".",
+    " "
+]
+
+# This text splitter is used to create the child documents
+child_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=400,
+    chunk_overlap=100,
+    length_function=len,
+    is_separator_regex=False,
+    separators=separators
+)
+
+
+def stable_id(*parts):
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def convert_to_documents(faqs):
+    # One parent document per answer: FAQ -> answers -> chunks. Ids are derived from the content, so they survive
+    # rebuilds, and an answer repeated word for word by the same doctor is stored once.
+    ids = []
+    docs = []
+    seen = set()
+
+    for faq in faqs:
+        faq_id = stable_id(faq['question'])
+
+        for answer in faq['answers']:
+            answer_id = f"{faq_id}-{stable_id(answer['dr_name'], answer['answer_text'])}"
+
+            if answer_id in seen:
+                continue
+
+            seen.add(answer_id)
+            ids.append(answer_id)
+            docs.append(Document(
+                page_content='\n\n'.join([faq['question'], answer['answer_text']]),
+                metadata={
+                    'faq_id': faq_id,
+                    'answer_id': answer_id,
+                    'title': faq.get('title', ''),
+                    'question': faq['question'],
+                    'dr_name': answer['dr_name'],
+                    'dr_exp': answer['dr_exp'],
+                }))
+
+    return ids, docs
+
+
+def group_answers(docs):
+    # Folds the retrieved answers back under their question, in order of the best-ranked answer of each FAQ
+    groups = {}
+
+    for doc in docs:
+        question = doc.metadata['question']
+        group = groups.setdefault(doc.metadata['faq_id'], {'question': question, 'answers': []})
+        group['answers'].append(doc)
+
+    return [Document(
+        page_content='\n\n'.join([group['question']] + [
+            doc.page_content[len(group['question']):].lstrip('\n') for doc in group['answers']]),
+        metadata={
+            'faq_id': faq_id,
+            'answers': [{key: doc.metadata[key] for key in ('answer_id', 'dr_name', 'dr_exp')}
+                        for doc in group['answers']],
+        }) for faq_id, group in groups.items()]
+
+
+class FaqRetriever(BaseRetriever):
+    # Entry point of an index: turns the optional specialty and doctor hints into a metadata filter over the
+    # answers, and groups the answers retrieved under their question
+
+    retriever: BaseRetriever
+    columns: Any
+    # answers ingested after the index was built, see app.live
+    live: Any = None
+    # the index directory, pruned once no generation serves from it
+    path: Any = None
+
+    def scope(self, specialty=None, doctor=None):
+        filter = {}
+
+        for key, hint in (('dr_exp', specialty), ('dr_name', doctor)):
+            values = self.columns.resolve(key, hint) if hint else []
+
+            if hint and self.live is not None:
+                values = sorted(set(values).union(self.live.resolve(key, hint)))
+
+            # a hint that matches nothing is ignored rather than answering from an empty partition
+            if values:
+                filter[key] = values
+
+        return filter
+
+    def _get_relevant_documents(self, query, *, run_manager=None, specialty=None, doctor=None):
+        filter = self.scope(specialty, doctor)
+        docs = self.retriever.invoke(query, **({'filter': filter} if filter else {}))
+
+        if self.live is not None:
+            with span('live_search'):
+                docs = self.live.merge(query, docs, filter)
+
+        return group_answers(docs)
+
+
+class FilteredParentDocumentRetriever(ParentDocumentRetriever):
+    # search_kwargs are fixed when the retriever is built, this one also takes a metadata filter per query. The
+    # chunk search (which embeds the query unless it is cached) and the parent lookup are timed separately.
+
+    translate_filter: Any = None
+
+    def _get_relevant_documents(self, query, *, run_manager, filter=None):
+        search_kwargs = dict(self.search_kwargs)
+
+        if filter:
+            search_kwargs['filter'] = self.translate_filter(filter) if self.translate_filter is not None else filter
+
+        with span('vector_search'):
+            chunks = self.vectorstore.similarity_search(query, **search_kwargs)
+
+        ids = []
+
+        for chunk in chunks:
+            if chunk.metadata[self.id_key] not in ids:
+                ids.append(chunk.metadata[self.id_key])
+
+        with span('docstore'):
+            return [doc for doc in self.docstore.mget(ids) if doc is not None]
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def index_path(index_dir, checksum, backend, embeddings):
+    # vectors from different encoders are not comparable, so each one gets its own index
+    encoder = getattr(embeddings, 'name', 'default').replace('/', '__')
+
+    return os.path.join(index_dir, f"v{INDEX_VERSION}-{backend}-{encoder}-{checksum[:16]}")
+
+
+def read_manifest(path):
+    manifest_file = os.path.join(path, 'manifest.json')
+
+    if not os.path.exists(manifest_file):
+        return None
+
+    with open(manifest_file) as fp:
+        return json.load(fp)
+
+
+def make_retriever(vectorstore, docstore, translate_filter=None):
+    return FilteredParentDocumentRetriever(
+        vectorstore=vectorstore,
+        docstore=docstore,
+        child_splitter=child_splitter,
+        translate_filter=translate_filter,
+    )
+
+
+def open_stores(path, embeddings, backend):
+    # The vectorstore indexes the child chunks, the docstore keeps the answers they were cut from
+    if backend == 'mmap':
+        return make_retriever(MmapVectorStore(os.path.join(path, 'vectors'), embeddings),
+                              MmapDocStore(os.path.join(path, 'docstore')))
+
+    vectorstore = Chroma(
+        collection_name=COLLECTION_NAME, embedding_function=embeddings,
+        persist_directory=os.path.join(path, 'chroma')
+    )
+
+    # Chroma filters on metadata inside the collection before ranking
+    return make_retriever(vectorstore, create_kv_docstore(LocalFileStore(os.path.join(path, 'docstore'))),
+                          translate_filter=to_chroma_where)
+
+
+def open_retriever(path, embeddings, backend, mode=RETRIEVAL_MODE, live=None):
+    retriever = open_stores(path, embeddings, backend)
+    # filterable metadata of the answers, row for row with bm25/ids.json
+    columns = MetadataColumns.load(path)
+
+    if mode != 'vector':
+        with open(os.path.join(path, 'bm25', 'ids.json')) as fp:
+            doc_ids = json.load(fp)
+
+        retriever = HybridRetriever(
+            vector_retriever=retriever,
+            lexical_index=BM25Index.load(os.path.join(path, 'bm25')),
+            docstore=retriever.docstore,
+            doc_ids=doc_ids,
+            columns=columns,
+            fast_path_margin=LEXICAL_FAST_PATH_MARGIN,
+        )
+
+    if live is not None:
+        live.docstore = retriever.docstore
+
+    return FaqRetriever(retriever=retriever, columns=columns, live=live, path=path)
+
+
+def write_mmap_index(path, doc_ids, docs, embeddings):
+    # Same split as ParentDocumentRetriever.add_documents, written straight to flat files
+    chunks = []
+
+    for doc_id, doc in zip(doc_ids, docs):
+        for chunk in child_splitter.split_documents([doc]):
+            chunk.metadata['doc_id'] = doc_id
+            chunks.append(chunk)
+
+    texts = [chunk.page_content for chunk in chunks]
+
+    MmapVectorStore.write(os.path.join(path, 'vectors'), texts, embeddings.embed_documents(texts),
+                          [chunk.metadata for chunk in chunks])
+    MmapDocStore.write(os.path.join(path, 'docstore'), doc_ids, docs)
+
+
+def build_index(faq_path, index_dir, embeddings, backend=INDEX_BACKEND):
+    checksum = file_checksum(faq_path)
+    path = index_path(index_dir, checksum, backend, embeddings)
+
+    # FAQs are streamed, only the answer documents built from them are kept
+    doc_ids, docs = convert_to_documents(read_records(faq_path))
+
+    # Build next to the final location and rename it into place, so readers never see a half-written index
+    os.makedirs(index_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix='.build-', dir=index_dir)
+
+    if backend == 'mmap':
+        write_mmap_index(build_dir, doc_ids, docs, embeddings)
+    else:
+        open_stores(build_dir, embeddings, backend).add_documents(docs, ids=doc_ids)
+
+    BM25Index.build([doc.page_content for doc in docs]).save(os.path.join(build_dir, 'bm25'))
+    MetadataColumns.build([doc.metadata for doc in docs]).save(build_dir)
+
+    # BM25 rows to docstore keys
+    with open(os.path.join(build_dir, 'bm25', 'ids.json'), 'w') as fp:
+        json.dump(doc_ids, fp)
+
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as fp:
+        json.dump({
+            'version': INDEX_VERSION,
+            'backend': backend,
+            'embeddings': getattr(embeddings, 'name', 'default'),
+            'source': os.path.abspath(faq_path),
+            'checksum': checksum,
+            'answers': len(docs),
+            'created': time.time(),
+        }, fp)
+
+    if os.path.exists(path) and read_manifest(path) is None:
+        shutil.rmtree(path)
+
+    try:
+        os.rename(build_dir, path)
+    except OSError:
+        # another worker finished the same build first
+        shutil.rmtree(build_dir)
+
+    return path
+
+
+def load_index(faq_path, index_dir, embeddings, backend=INDEX_BACKEND, live=None):
+    checksum = file_checksum(faq_path)
+    path = index_path(index_dir, checksum, backend, embeddings)
+    manifest = read_manifest(path)
+
+    if manifest is None or manifest['checksum'] != checksum:
+        logger.warning("no index matches %s, building %s", faq_path, path)
+        path = build_index(faq_path, index_dir, embeddings, backend)
+
+    return open_retriever(path, embeddings, backend, live=live)
+
+
+def prune_indexes(index_dir, keep=INDEX_KEEP, exclude=()):
+    # Deletes all but the `keep` most recently built indexes, never those in `exclude`. Builds still in progress
+    # (.build-*) and directories without a manifest are left alone.
+    built = []
+
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        manifest = read_manifest(path) if os.path.isdir(path) and not name.startswith('.') else None
+
+        if manifest is not None:
+            built.append((manifest.get('created', 0), path))
+
+    built.sort(reverse=True)
+    excluded = {os.path.abspath(path) for path in exclude if path is not None}
+    removed = []
+
+    for _, path in built[keep:]:
+        if os.path.abspath(path) not in excluded:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+
+    return removed
+
+
+if __name__ == "__main__":
+    from app.embeddings import load_embeddings
+
+    parser = argparse.ArgumentParser(description="Build the retrieval index for a FAQ file ahead of serving")
+    parser.add_argument('--faqs', default=FAQ_PATH)
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    parser.add_argument('--backend', choices=['chroma', 'mmap'], default=INDEX_BACKEND)
+    args = parser.parse_args()
+
+    print(f"index written to {build_index(args.faqs, args.index_dir, load_embeddings(), args.backend)}")
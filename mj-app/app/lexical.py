@@ -0,0 +1,184 @@
+import json
+import os
+import re
+from collections import Counter
+from typing import Any
+
+import numpy as np
+from faq_common.normalize import normalize_text
+from langchain_core.retrievers import BaseRetriever
+
+from app.metrics import span
+
+token_pattern = re.compile(r'\w+')
+
+
+def tokenize(text):
+    # Same character normalization as the crawler, so ی/ي, ک/ك and digit variants meet on one token
+    return token_pattern.findall(normalize_text(text).lower())
+
+
+# the arrays of a BM25Index that are saved
+ARRAYS = ('offsets', 'doc_ids', 'term_freqs', 'doc_lengths', 'idf', 'length_norm')
+
+
+def top_hits(scores, matched, k, mask=None):
+    # The k best-scoring rows with a score above 0, as BM25Index.search returns them
+    if mask is not None:
+        scores[~mask] = 0
+
+    k = min(k, int(np.count_nonzero(scores)))
+
+    if k == 0:
+        return [], []
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+
+    return [(int(row), float(scores[row])) for row in top], [int(matched[row]) for row in top]
+
+
+class BM25Index:
+    # Okapi BM25 over an inverted index stored as flat arrays: for term t, doc_ids[offsets[t]:offsets[t + 1]] are
+    # the documents containing it and term_freqs the matching counts.
+
+    def __init__(self, vocabulary, offsets, doc_ids, term_freqs, doc_lengths, k1=1.5, b=0.75, idf=None,
+                 length_norm=None):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        # computed when the index is built and memory-mapped with the rest when it is loaded
+        if idf is None:
+            doc_count = len(doc_lengths)
+            doc_freqs = np.diff(offsets)
+            idf = np.log(1 + (doc_count - doc_freqs + 0.5) / (doc_freqs + 0.5))
+            length_norm = k1 * (1 - b + b * doc_lengths / max(doc_lengths.mean(), 1)) if doc_count else doc_lengths
+
+        self.idf = idf
+        self.length_norm = length_norm
+
+    @classmethod
+    def build(cls, texts, **kwargs):
+        postings = {}
+        doc_lengths = []
+
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((row, count))
+
+        vocabulary = {term: i for i, term in enumerate(postings)}
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(entries) for entries in postings.values()])
+        entries = [entry for term_entries in postings.values() for entry in term_entries]
+
+        return cls(vocabulary, offsets,
+                   np.array([row for row, _ in entries], dtype=np.int32),
+                   np.array([count for _, count in entries], dtype=np.float32),
+                   np.array(doc_lengths, dtype=np.float32), **kwargs)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, 'vocabulary.json'), 'w') as fp:
+            json.dump({'k1': self.k1, 'b': self.b, 'terms': self.vocabulary}, fp, ensure_ascii=False)
+
+        # one .npy per array, so that workers can map them instead of each loading a copy
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'vocabulary.json')) as fp:
+            saved = json.load(fp)
+
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+
+        return cls(saved['terms'], k1=saved['k1'], b=saved['b'], **arrays)
+
+    def search(self, query, k=4, mask=None):
+        # Returns the top k (row, score) pairs and, per returned row, how many distinct query terms it contains.
+        # With a boolean mask over the rows, only the rows it allows can be returned.
+        terms = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+
+        if not terms:
+            return [], []
+
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        matched = np.zeros(len(self.doc_lengths), dtype=np.int32)
+
+        for term in terms:
+            rows = self.doc_ids[self.offsets[term]:self.offsets[term + 1]]
+            tf = self.term_freqs[self.offsets[term]:self.offsets[term + 1]]
+
+            scores[rows] += self.idf[term] * tf * (self.k1 + 1) / (tf + self.length_norm[rows])
+            matched[rows] += 1
+
+        return top_hits(scores, matched, k, mask)
+
+    def query_terms(self, query):
+        return len(set(tokenize(query)))
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    scores = {}
+
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0) + 1 / (k + rank + 1)
+
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    # BM25 over the parent documents fused with the dense retriever by reciprocal rank. When the best lexical hit
+    # contains every query term and clearly beats the runner-up, the dense stage is skipped altogether. A metadata
+    # filter restricts both stages.
+
+    vector_retriever: BaseRetriever
+    lexical_index: Any
+    docstore: Any
+    doc_ids: list
+    columns: Any = None
+    k: int = 4
+    rrf_k: int = 60
+    fast_path_margin: float = 2.0
+
+    def _lexical_fast_path(self, query, hits, matched):
+        if not hits or self.fast_path_margin <= 0 or matched[0] < self.lexical_index.query_terms(query):
+            return False
+
+        return len(hits) == 1 or hits[0][1] >= self.fast_path_margin * hits[1][1]
+
+    def _get_relevant_documents(self, query, *, run_manager=None, filter=None):
+        with span('lexical_search'):
+            mask = self.columns.mask(filter) if filter else None
+            hits, matched = self.lexical_index.search(query, self.k, mask=mask)
+
+        with span('docstore'):
+            lexical_docs = self.docstore.mget([self.doc_ids[row] for row, _ in hits])
+
+        if self._lexical_fast_path(query, hits, matched):
+            return [doc for doc in lexical_docs if doc is not None]
+
+        vector_docs = self.vector_retriever.invoke(query, **({'filter': filter} if filter else {}))
+
+        docs = {}
+
+        for doc in vector_docs + lexical_docs:
+            if doc is not None:
+                docs.setdefault(doc.page_content, doc)
+
+        ranking = reciprocal_rank_fusion(
+            [[doc.page_content for doc in vector_docs], [doc.page_content for doc in lexical_docs if doc is not None]],
+            k=self.rrf_k,
+        )
+
+        return [docs[key] for key in ranking[:self.k]]
@@ -0,0 +1,404 @@
+import fcntl
+import json
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from faq_common.jsonl import JsonlWriter, read_records, write_records
+
+from app.filters import FILTER_KEYS, MetadataColumns
+from app.index import child_splitter, convert_to_documents, stable_id
+from app.lexical import reciprocal_rank_fusion, tokenize, top_hits
+
+# Chats posted to /admin/ingest. Every worker follows it, and it is replayed into the live segment of every new
+# index generation, which drops the chats the index already has.
+INGEST_LOG = os.environ.get('INGEST_LOG', '../ingested.jsonl')
+# same default as prepare_docs.py --threshold
+INGEST_THRESHOLD = float(os.environ.get('INGEST_THRESHOLD', 0.85))
+
+
+def unit_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def chat_id(chat):
+    return stable_id(json.dumps(chat, ensure_ascii=False, sort_keys=True))
+
+
+class GrowingArray:
+    # Append-only array whose capacity doubles, so adding n rows costs O(n) overall. view(size) keeps showing the
+    # same rows while more are added: a larger buffer is a new array, and appends only write past the end.
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.data = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        needed = self.size + len(rows)
+
+        if self.data is None or needed > len(self.data):
+            data = np.empty((max(needed, 16, 2 * self.size),) + rows.shape[1:], dtype=self.dtype)
+
+            if self.data is not None:
+                data[:self.size] = self.data[:self.size]
+
+            self.data = data
+
+        self.data[self.size:needed] = rows
+        self.size = needed
+
+    def view(self, size=None):
+        return self.data[:self.size if size is None else size]
+
+
+class LiveLexicalIndex:
+    # BM25 with the scoring of app.lexical.BM25Index, over postings that are appended to instead of rebuilt.
+    # A search only sees the first `size` documents, so it can run on a snapshot while answers are added.
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = GrowingArray(np.float32)
+        self.total_length = 0
+
+    def add(self, texts):
+        lengths = []
+
+        for text in texts:
+            tokens = tokenize(text)
+            row = len(self.doc_lengths) + len(lengths)
+            lengths.append(len(tokens))
+
+            for term, count in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((row, count))
+
+        self.doc_lengths.extend(lengths)
+        self.total_length += sum(lengths)
+
+    def search(self, query, size, total_length, k=4, mask=None):
+        doc_lengths = self.doc_lengths.view(size)
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(total_length / size, 1))
+        scores = np.zeros(size, dtype=np.float32)
+        matched = np.zeros(size, dtype=np.int32)
+
+        for term in set(tokenize(query)):
+            # a copy, the list may be appended to meanwhile
+            entries = np.array(self.postings.get(term, [])[:], dtype=np.int64).reshape(-1, 2)
+            entries = entries[entries[:, 0] < size]
+
+            if not len(entries):
+                continue
+
+            rows, tf = entries[:, 0], entries[:, 1].astype(np.float32)
+            idf = np.log(1 + (size - len(rows) + 0.5) / (len(rows) + 0.5))
+
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + length_norm[rows])
+            matched[rows] += 1
+
+        return top_hits(scores, matched, k, mask)
+
+
+class LiveColumns(MetadataColumns):
+    # MetadataColumns that grow with the segment. Codes follow the order values were first seen in.
+
+    def __init__(self, keys=FILTER_KEYS):
+        self.values = {key: [] for key in keys}
+        self.lookup = {key: {} for key in keys}
+        self.columns = {key: GrowingArray(np.int32) for key in keys}
+
+    @property
+    def codes(self):
+        return {key: column.view() for key, column in self.columns.items()}
+
+    def add(self, metadatas):
+        for key, column in self.columns.items():
+            codes = []
+
+            for metadata in metadatas:
+                value = metadata.get(key, '')
+
+                if value not in self.lookup[key]:
+                    self.values[key].append(value)
+                    self.lookup[key][value] = len(self.values[key]) - 1
+
+                codes.append(self.lookup[key][value])
+
+            column.extend(codes)
+
+
+class LiveSegment:
+    # Answers ingested while the server runs, searched next to the prebuilt index so they are retrievable as soon as
+    # they are posted. An incoming chat joins the FAQ whose question is the most similar one when the cosine
+    # similarity is above the threshold, the rule prepare_docs.py applies, and starts a new FAQ otherwise; answers
+    # the index or the segment already has are skipped. Posted chats go through the ingest log, which every worker
+    # reads from where it left off, so all of them serve the same answers. Vectors, postings and filter columns are
+    # appended to, and searches read the first rows of them as counted in a snapshot that every ingest replaces, so
+    # they never wait for one.
+
+    def __init__(self, embeddings, faq_path, log_path=INGEST_LOG, threshold=INGEST_THRESHOLD, k=4):
+        self.embeddings = embeddings
+        self.faq_path = faq_path
+        self.log_path = log_path
+        self.threshold = threshold
+        self.k = k
+        # the index's docstore, to skip answers it already has
+        self.docstore = None
+
+        self.lock = threading.Lock()
+        self.faqs = None
+        self.ids = set()
+        self.docs = []
+        self.chunk_vectors = GrowingArray(np.float32)
+        self.chunk_rows = GrowingArray(np.int64)
+        self.lexical = LiveLexicalIndex()
+        self.columns = LiveColumns()
+        # (answers, chunks, total token count) searches may read
+        self.snapshot = None
+
+        # chats already applied, and how far the log has been read
+        self.seen = set()
+        self.log_inode = None
+        self.log_offset = 0
+
+        self.chats = 0
+        self.answers = 0
+        self.duplicates = 0
+        self.merged = 0
+        self.new_faqs = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _load_faqs(self):
+        # questions of the indexed FAQs, embedded on the first ingest (prepare_docs.py cached most of them)
+        questions = [faq['question'] for faq in read_records(self.faq_path)]
+        vectors = GrowingArray(np.float32)
+
+        if questions:
+            vectors.extend(unit_rows(self.embeddings.embed_documents(questions)))
+
+        self.faqs = {'ids': [stable_id(question) for question in questions], 'questions': questions,
+                     'vectors': vectors}
+
+    def _assign(self, chats):
+        # The FAQ every chat belongs to, as (faq_id, question). Chats of the same batch can match each other.
+        if self.faqs is None:
+            self._load_faqs()
+
+        faqs = self.faqs
+        vectors = unit_rows(self.embeddings.embed_documents([chat['question'] for chat in chats]))
+        assigned = []
+
+        for chat, vector in zip(chats, vectors):
+            if len(faqs['vectors']):
+                scores = faqs['vectors'].view() @ vector
+                best = int(np.argmax(scores))
+
+                if scores[best] > self.threshold:
+                    self.merged += 1
+                    assigned.append((faqs['ids'][best], faqs['questions'][best]))
+                    continue
+
+            self.new_faqs += 1
+            faq_id = stable_id(chat['question'])
+            faqs['ids'].append(faq_id)
+            faqs['questions'].append(chat['question'])
+            faqs['vectors'].extend(vector[None])
+            assigned.append((faq_id, chat['question']))
+
+        return assigned
+
+    @contextmanager
+    def _log_lock(self):
+        # serializes appends and compactions of the log between workers
+        with open(self.log_path + '.lock', 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def add(self, chats, log=True):
+        # Indexes scraped chats ({'title', 'question', 'answers'}), returns how many answers were new. With the log,
+        # they are appended to it and read back by sync(), along with what other workers appended since.
+        chats = [chat for chat in chats if chat.get('question') and chat.get('answers')]
+
+        if not chats:
+            return 0
+
+        if not (log and self.log_path):
+            with self.lock:
+                return self._apply(chats)[0]
+
+        with self._log_lock():
+            with JsonlWriter(self.log_path, append=True) as writer:
+                writer.write_all(chats)
+
+        return self.sync()
+
+    def _apply(self, chats):
+        # Returns how many answers were new, and the chats the index does not have every answer of
+        chats = [chat for chat in chats if chat.get('question') and chat.get('answers')]
+        new = []
+
+        for chat in chats:
+            key = chat_id(chat)
+
+            if key not in self.seen:
+                self.seen.add(key)
+                new.append(chat)
+
+        if not new:
+            return 0, []
+
+        per_chat = [convert_to_documents([dict(chat, question=question)])
+                    for chat, (_, question) in zip(new, self._assign(new))]
+        doc_ids = [doc_id for ids, _ in per_chat for doc_id in ids]
+        known = iter(self.docstore.mget(doc_ids) if self.docstore is not None else [None] * len(doc_ids))
+
+        fresh, fresh_ids, pending = [], set(), []
+
+        for chat, (ids, docs) in zip(new, per_chat):
+            indexed = [next(known) is not None for _ in ids]
+
+            if not all(indexed):
+                pending.append(chat)
+
+            for doc_id, doc, in_index in zip(ids, docs, indexed):
+                if not in_index and doc_id not in self.ids and doc_id not in fresh_ids:
+                    fresh_ids.add(doc_id)
+                    fresh.append((doc_id, doc))
+
+        self.chats += len(new)
+        self.duplicates += len(doc_ids) - len(fresh)
+
+        if fresh:
+            self._index(fresh)
+
+        return len(fresh), pending
+
+    def _index(self, fresh):
+        # same split as the index, the chunks point back at their answer's row
+        chunks = []
+        rows = []
+
+        for doc_id, doc in fresh:
+            self.ids.add(doc_id)
+
+            for chunk in child_splitter.split_documents([doc]):
+                chunks.append(chunk.page_content)
+                rows.append(len(self.docs))
+
+            self.docs.append(doc)
+
+        self.chunk_vectors.extend(unit_rows(self.embeddings.embed_documents(chunks)))
+        self.chunk_rows.extend(rows)
+        self.lexical.add([doc.page_content for _, doc in fresh])
+        self.columns.add([doc.metadata for _, doc in fresh])
+        self.answers += len(fresh)
+
+        self.snapshot = (len(self.docs), len(self.chunk_rows), self.lexical.total_length)
+
+    def _read_log(self, fp):
+        # the complete lines from log_offset on, a line still being written is read on the next call
+        fp.seek(self.log_offset)
+        data = fp.read()
+        end = data.rfind(b'\n') + 1
+        self.log_offset += end
+
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+    def sync(self):
+        # Applies the chats appended to the log since the last call, by this worker or another one. Returns how
+        # many answers were new.
+        if not self.log_path or not os.path.exists(self.log_path):
+            return 0
+
+        with self.lock, open(self.log_path, 'rb') as fp:
+            inode = os.fstat(fp.fileno()).st_ino
+
+            if inode != self.log_inode:
+                # compacted by another worker: read from the top, the chats already applied are skipped
+                self.log_inode, self.log_offset = inode, 0
+
+            return self._apply(self._read_log(fp))[0]
+
+    def replay(self):
+        # Applies the whole log to a new generation. Chats its index has every answer of, because the FAQ file was
+        # rebuilt with them, are dropped from the log along with repeated ones.
+        if not self.log_path or not os.path.exists(self.log_path):
+            return 0
+
+        with self._log_lock(), self.lock:
+            with open(self.log_path, 'rb') as fp:
+                self.log_inode, self.log_offset = os.fstat(fp.fileno()).st_ino, 0
+                chats = self._read_log(fp)
+
+            added, pending = self._apply(chats)
+
+            if len(pending) < len(chats):
+                write_records(self.log_path, pending)
+                self.log_inode, self.log_offset = os.stat(self.log_path).st_ino, os.path.getsize(self.log_path)
+
+            return added
+
+    def resolve(self, key, hint):
+        return self.columns.resolve(key, hint) if self.snapshot is not None else []
+
+    def search(self, query, filter=None):
+        # The segment's own hybrid ranking: best chunk per answer fused with BM25, both restricted by the filter
+        snapshot = self.snapshot
+
+        if snapshot is None:
+            return []
+
+        size, chunk_count, total_length = snapshot
+        mask = self.columns.mask(filter, slice(0, size)) if filter else None
+
+        scores = self.chunk_vectors.view(chunk_count) @ np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        best = np.full(size, -np.inf, dtype=np.float32)
+        np.maximum.at(best, self.chunk_rows.view(chunk_count), scores)
+
+        if mask is not None:
+            best[~mask] = -np.inf
+
+        dense = [int(row) for row in np.argsort(-best)[:self.k] if best[row] > -np.inf]
+        hits, _ = self.lexical.search(query, size, total_length, self.k, mask=mask)
+
+        rows = reciprocal_rank_fusion([dense, [row for row, _ in hits]])
+
+        return [self.docs[row] for row in rows[:self.k]]
+
+    def merge(self, query, docs, filter=None):
+        # Fuses the index's answers with the segment's by reciprocal rank
+        live_docs = self.search(query, filter)
+
+        if not live_docs:
+            return docs
+
+        by_id = {doc.metadata['answer_id']: doc for doc in live_docs + docs}
+        ranking = reciprocal_rank_fusion([[doc.metadata['answer_id'] for doc in docs],
+                                          [doc.metadata['answer_id'] for doc in live_docs]])
+
+        return [by_id[answer_id] for answer_id in ranking[:max(len(docs), self.k)]]
+
+    def stats(self):
+        return {
+            'chats': self.chats,
+            'answers': self.answers,
+            'duplicate_answers': self.duplicates,
+            'merged_chats': self.merged,
+            'new_faqs': self.new_faqs,
+            'chunks': len(self.chunk_rows),
+        }
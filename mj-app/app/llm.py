@@ -0,0 +1,358 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+from langchain_core.runnables import Runnable
+
+from app.metrics import record, record_usage
+
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+# Comma-separated pool of Ollama servers, requests go to the least busy healthy one
+OLLAMA_BASE_URLS = [url.strip() for url in os.environ.get('OLLAMA_BASE_URLS', OLLAMA_BASE_URL).split(',')
+                    if url.strip()]
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.1')
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 120))
+# per endpoint
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 32))
+# seconds between health checks of every endpoint, 0 turns them off
+LLM_HEALTH_INTERVAL = float(os.environ.get('LLM_HEALTH_INTERVAL', 10))
+# identical prompts in flight at the same time share one generation
+LLM_COALESCE = os.environ.get('LLM_COALESCE', '1') not in ('0', 'false', '')
+
+
+def can_fail_over(error):
+    # errors another endpoint may not run into: this one is down, overloaded or does not have the model
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 404
+
+    return isinstance(error, httpx.TransportError)
+
+
+class OllamaEndpoint:
+
+    def __init__(self, url, timeout, max_connections):
+        self.url = url
+
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.Client(base_url=url, timeout=timeout, limits=limits)
+        self.aclient = httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits)
+
+        self.healthy = True
+        self.active = 0
+        self.requests = 0
+        self.failures = 0
+        # moving average of the request duration
+        self.seconds = None
+
+    def check(self, model):
+        # healthy when the server answers and has the model
+        try:
+            response = self.client.get('/api/tags', timeout=5)
+            response.raise_for_status()
+            names = {model['name'] for model in response.json().get('models', [])}
+            self.healthy = model in names or f"{model}:latest" in names
+        except (httpx.HTTPError, ValueError):
+            self.healthy = False
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'active': self.active,
+            'requests': self.requests,
+            'failures': self.failures,
+            'mean_ms': self.seconds * 1000 if self.seconds is not None else None,
+        }
+
+
+class SharedStream:
+    # One streamed generation read by every request that asked for the same prompt while it was running. Tokens are
+    # kept, so a request joining late gets the ones it missed first. The generation stops once nobody reads it.
+
+    def __init__(self, tokens):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(tokens))
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _run(self, tokens):
+        try:
+            async for token in tokens:
+                self.tokens.append(token)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def read(self):
+        self.readers += 1
+        sent = 0
+
+        try:
+            while True:
+                while sent < len(self.tokens):
+                    yield self.tokens[sent]
+                    sent += 1
+
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+
+                    return
+
+                await self.changed.wait()
+        finally:
+            self.readers -= 1
+
+            if self.readers == 0 and not self.done:
+                self.task.cancel()
+
+
+class OllamaGenerator(Runnable):
+    # Talks to Ollama's /api/generate on a pool of servers, each with one sync and one async keep-alive client
+    # shared by every request. A request goes to the healthy endpoint with the fewest requests in flight. When that
+    # endpoint fails before sending anything it is marked unhealthy and the next one is tried; health checks in the
+    # background bring it back. Accepts a prompt value or a plain string, returns or streams the generated text.
+
+    def __init__(self, model=OLLAMA_MODEL, base_urls=OLLAMA_BASE_URLS, timeout=LLM_TIMEOUT,
+                 max_connections=LLM_MAX_CONNECTIONS, options=None, health_interval=LLM_HEALTH_INTERVAL,
+                 coalesce=LLM_COALESCE):
+        self.model = model
+        self.options = options or {}
+        self.coalesce = coalesce
+
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+
+        self.endpoints = [OllamaEndpoint(url, timeout, max_connections) for url in base_urls]
+
+        self._lock = threading.Lock()
+        # in-flight generations by payload, only touched from the event loop
+        self._requests = {}
+        self._streams = {}
+        self.coalesced = 0
+        self.failovers = 0
+
+        if health_interval > 0:
+            threading.Thread(target=self._check_health, args=(health_interval,), name='ollama-health',
+                             daemon=True).start()
+
+    def _check_health(self, interval):
+        while True:
+            for endpoint in self.endpoints:
+                endpoint.check(self.model)
+
+            time.sleep(interval)
+
+    def _payload(self, input, stream):
+        prompt = input if isinstance(input, str) else input.to_string()
+
+        return {'model': self.model, 'prompt': prompt, 'stream': stream, 'options': self.options}
+
+    def _read_line(self, line, start, started):
+        # one line of a streamed generation, the last one carries the token counts
+        data = json.loads(line) if line else {}
+
+        if data.get('done'):
+            record_usage(data)
+
+        if data.get('response') and not started:
+            record('llm_first_token', time.perf_counter() - start)
+
+        return data.get('response')
+
+    def _candidates(self):
+        # healthy endpoints first, least loaded first; unhealthy ones are still tried when nothing else works
+        with self._lock:
+            return sorted(self.endpoints, key=lambda endpoint: (not endpoint.healthy, endpoint.active,
+                                                                endpoint.seconds or 0))
+
+    @contextmanager
+    def _track(self, endpoint):
+        with self._lock:
+            endpoint.active += 1
+            endpoint.requests += 1
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        except httpx.HTTPError as e:
+            if can_fail_over(e):
+                endpoint.failures += 1
+                endpoint.healthy = False
+
+            raise
+        else:
+            seconds = time.perf_counter() - start
+            record('llm', seconds)
+            endpoint.seconds = seconds if endpoint.seconds is None else 0.8 * endpoint.seconds + 0.2 * seconds
+            endpoint.healthy = True
+        finally:
+            with self._lock:
+                endpoint.active -= 1
+
+    def invoke(self, input, config=None, **kwargs):
+        payload = self._payload(input, False)
+        error = None
+
+        for endpoint in self._candidates():
+            try:
+                with self._track(endpoint):
+                    response = endpoint.client.post('/api/generate', json=payload)
+                    response.raise_for_status()
+
+                data = response.json()
+                record_usage(data)
+
+                return data['response']
+            except httpx.HTTPError as e:
+                if not can_fail_over(e):
+                    raise
+
+                self.failovers += 1
+                error = e
+
+        raise error
+
+    async def _ainvoke(self, payload):
+        error = None
+
+        for endpoint in self._candidates():
+            try:
+                with self._track(endpoint):
+                    response = await endpoint.aclient.post('/api/generate', json=payload)
+                    response.raise_for_status()
+
+                data = response.json()
+                record_usage(data)
+
+                return data['response']
+            except httpx.HTTPError as e:
+                if not can_fail_over(e):
+                    raise
+
+                self.failovers += 1
+                error = e
+
+        raise error
+
+    def _coalesced(self, inflight, payload, start):
+        # the task or stream already running for this payload, or a new one
+        key = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        shared = inflight.get(key)
+
+        if shared is not None:
+            self.coalesced += 1
+            return shared
+
+        shared = start()
+        inflight[key] = shared
+        task = shared if isinstance(shared, asyncio.Future) else shared.task
+        task.add_done_callback(lambda _: inflight.pop(key, None) if inflight.get(key) is shared else None)
+
+        return shared
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        payload = self._payload(input, False)
+
+        if not self.coalesce:
+            return await self._ainvoke(payload)
+
+        task = self._coalesced(self._requests, payload, lambda: asyncio.ensure_future(self._ainvoke(payload)))
+
+        # a caller that goes away does not cancel the generation the others are waiting for
+        return await asyncio.shield(task)
+
+    def stream(self, input, config=None, **kwargs):
+        payload = self._payload(input, True)
+        error = None
+
+        for endpoint in self._candidates():
+            started = False
+            start = time.perf_counter()
+
+            try:
+                with self._track(endpoint):
+                    with endpoint.client.stream('POST', '/api/generate', json=payload) as response:
+                        response.raise_for_status()
+
+                        for line in response.iter_lines():
+                            token = self._read_line(line, start, started)
+
+                            if token:
+                                started = True
+                                yield token
+
+                return
+            except httpx.HTTPError as e:
+                # tokens already sent cannot be taken back
+                if started or not can_fail_over(e):
+                    raise
+
+                self.failovers += 1
+                error = e
+
+        raise error
+
+    async def _astream(self, payload):
+        error = None
+
+        for endpoint in self._candidates():
+            started = False
+            start = time.perf_counter()
+
+            try:
+                with self._track(endpoint):
+                    async with endpoint.aclient.stream('POST', '/api/generate', json=payload) as response:
+                        response.raise_for_status()
+
+                        async for line in response.aiter_lines():
+                            token = self._read_line(line, start, started)
+
+                            if token:
+                                started = True
+                                yield token
+
+                return
+            except httpx.HTTPError as e:
+                if started or not can_fail_over(e):
+                    raise
+
+                self.failovers += 1
+                error = e
+
+        raise error
+
+    async def astream(self, input, config=None, **kwargs):
+        payload = self._payload(input, True)
+
+        if not self.coalesce:
+            async for token in self._astream(payload):
+                yield token
+
+            return
+
+        shared = self._coalesced(self._streams, payload, lambda: SharedStream(self._astream(payload)))
+
+        async for token in shared.read():
+            yield token
+
+    def stats(self):
+        return {
+            'endpoints': [endpoint.stats() for endpoint in self.endpoints],
+            'coalesced': self.coalesced,
+            'failovers': self.failovers,
+        }
@@ -0,0 +1,231 @@
+import bisect
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from fastapi.responses import PlainTextResponse
+
+# Metrics in the Prometheus text format, kept per worker process. Stages record spans with `with span('stage'):`,
+# which feed the rag_stage_seconds histogram and the trace of the request they run in.
+
+# Share of retrievals run under cProfile, 0 turns profiling off
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# Profiles of sampled retrievals at least this slow are written to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 200))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '../profiles')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 8192)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value not in (float('inf'), float('-inf')) else ('+Inf' if value > 0 else '-Inf')
+
+
+class Metric:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+        with self._lock:
+            values = sorted(self.values.items())
+
+        for key, value in values:
+            lines.extend(self.samples(dict(zip(self.labels, key)), value))
+
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, labels, value):
+        yield f"{self.name}{format_labels(labels)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            # a bucket counts the values up to and including its bound
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self, labels, value):
+        counts, total = value
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield f"{self.name}_bucket{format_labels(dict(labels, le=format_value(bound)))} {cumulative}"
+
+        yield f"{self.name}_sum{format_labels(labels)} {format_value(total)}"
+        yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+
+
+def render():
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+STAGE_SECONDS = Histogram('rag_stage_seconds', "Time spent in each stage of a request", ['stage'])
+REQUEST_SECONDS = Histogram('rag_request_seconds', "Time until the last byte of the response", ['path', 'status'])
+REQUESTS = Counter('rag_requests_total', "Requests answered", ['path', 'status'])
+RETRIEVED_DOCS = Histogram('rag_retrieved_docs', "Documents handed to the prompt", buckets=COUNT_BUCKETS)
+PROMPT_TOKENS = Histogram('rag_prompt_tokens', "Prompt tokens of a generation, as counted by Ollama",
+                          buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS = Histogram('rag_generated_tokens', "Tokens generated, as counted by Ollama", buckets=TOKEN_BUCKETS)
+CACHE_LOOKUPS = Counter('rag_answer_cache_lookups_total', "Answer cache lookups", ['result'])
+PROFILES = Counter('rag_profiles_total', "cProfile traces of slow retrievals written to PROFILE_DIR")
+
+
+class Trace:
+    # Time per stage of one request. Spans of the same stage add up.
+
+    def __init__(self):
+        self.spans = {}
+
+    def add(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0) + seconds
+
+    def summary(self):
+        return {stage: seconds * 1000 for stage, seconds in self.spans.items()}
+
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def record(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = current_trace.get()
+
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record_usage(response):
+    # the counts Ollama adds to a finished generation
+    if response.get('prompt_eval_count') is not None:
+        PROMPT_TOKENS.observe(response['prompt_eval_count'])
+
+    if response.get('eval_count') is not None:
+        GENERATED_TOKENS.observe(response['eval_count'])
+
+
+def profiled(function, sample_rate=PROFILE_SAMPLE_RATE, slow_ms=PROFILE_SLOW_MS, directory=PROFILE_DIR):
+    # Runs a random share of the calls under cProfile and keeps the profiles of the slow ones, for
+    # `python -m pstats` or snakeviz. Meant for the blocking stages, which run in one thread from start to end.
+    if sample_rate <= 0:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if random.random() >= sample_rate:
+            return function(*args, **kwargs)
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is running, possible from Python 3.12 on
+            return function(*args, **kwargs)
+
+        start = time.perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            ms = (time.perf_counter() - start) * 1000
+
+            if ms >= slow_ms:
+                os.makedirs(directory, exist_ok=True)
+                profile.dump_stats(os.path.join(
+                    directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{ms:.0f}ms.prof"))
+                PROFILES.inc()
+
+    return wrapper
+
+
+def instrument_requests(app, path_prefix):
+    # Requests under path_prefix get a trace for their spans and are timed until their last byte is sent.
+    # /metrics serves everything recorded by this process.
+
+    @app.middleware("http")
+    async def observe(request, call_next):
+        if not request.url.path.startswith(path_prefix):
+            return await call_next(request)
+
+        current_trace.set(Trace())
+        start = time.perf_counter()
+        response = await call_next(request)
+        body = response.body_iterator
+
+        async def observe_when_sent():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                labels = {'path': request.url.path, 'status': response.status_code}
+                REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+                REQUESTS.inc(**labels)
+
+        response.body_iterator = observe_when_sent()
+
+        return response
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,190 @@
+import json
+import mmap
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+from langchain_core.vectorstores import VectorStore
+
+from app.filters import MetadataColumns
+
+# Read-only stores backed by memory-mapped files. Every uvicorn worker maps the same files, so the vectors and
+# parent documents live once in the page cache instead of once per process.
+
+# Chunks are stored sorted by this key, so filtering on it scans only the matching slices of the matrix
+PARTITION_KEY = 'dr_exp'
+
+
+def write_blobs(path, items):
+    # items are JSON-serialisable; path.bin holds them back to back, path.idx their int64 offsets
+    offsets = [0]
+
+    with open(path + '.bin', 'wb') as fp:
+        for item in items:
+            data = json.dumps(item, ensure_ascii=False).encode('utf-8')
+            fp.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+    np.asarray(offsets, dtype=np.int64).tofile(path + '.idx')
+
+
+class MmapBlobs:
+
+    def __init__(self, path):
+        self.offsets = np.memmap(path + '.idx', dtype=np.int64, mode='r')
+
+        with open(path + '.bin', 'rb') as fp:
+            # mmap refuses empty files
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fp.fileno()).st_size else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return json.loads(self.data[self.offsets[row]:self.offsets[row + 1]])
+
+
+def _to_document(item):
+    return Document(page_content=item['page_content'], metadata=item['metadata'])
+
+
+def _from_document(doc):
+    return {'page_content': doc.page_content, 'metadata': doc.metadata}
+
+
+class MmapDocStore(BaseStore[str, Document]):
+
+    def __init__(self, path):
+        self.blobs = MmapBlobs(os.path.join(path, 'docs'))
+
+        with open(os.path.join(path, 'keys.json')) as fp:
+            self.rows = {key: row for row, key in enumerate(json.load(fp))}
+
+    @classmethod
+    def write(cls, path, keys, docs):
+        os.makedirs(path, exist_ok=True)
+        write_blobs(os.path.join(path, 'docs'), [_from_document(doc) for doc in docs])
+
+        with open(os.path.join(path, 'keys.json'), 'w') as fp:
+            json.dump(list(keys), fp)
+
+    def mget(self, keys):
+        return [_to_document(self.blobs[self.rows[key]]) if key in self.rows else None for key in keys]
+
+    def mset(self, key_value_pairs):
+        raise TypeError("MmapDocStore is read-only, rebuild the index to change it")
+
+    def mdelete(self, keys):
+        raise TypeError("MmapDocStore is read-only, rebuild the index to change it")
+
+    def yield_keys(self, prefix=None):
+        for key in self.rows:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+
+class MmapVectorStore(VectorStore):
+    # Exact cosine search over a float32 matrix that is never copied into process memory. Searches take an
+    # optional filter, a dict from metadata key to accepted values.
+
+    def __init__(self, path, embedding):
+        self.embedding = embedding
+        self.chunks = MmapBlobs(os.path.join(path, 'chunks'))
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.columns = MetadataColumns.load(path)
+
+        # rows are sorted by partition value and codes follow the sorted values, so each partition is one slice
+        codes = self.columns.codes[PARTITION_KEY]
+        self.partitions = {
+            value: (int(np.searchsorted(codes, code)), int(np.searchsorted(codes, code, side='right')))
+            for code, value in enumerate(self.columns.values[PARTITION_KEY])
+        }
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    @classmethod
+    def write(cls, path, texts, vectors, metadatas):
+        os.makedirs(path, exist_ok=True)
+
+        order = sorted(range(len(texts)), key=lambda row: metadatas[row].get(PARTITION_KEY, ''))
+        texts = [texts[row] for row in order]
+        metadatas = [metadatas[row] for row in order]
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(order), -1)[order]
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        np.save(os.path.join(path, 'vectors.npy'), vectors)
+        write_blobs(os.path.join(path, 'chunks'),
+                    [{'page_content': text, 'metadata': metadata} for text, metadata in zip(texts, metadatas)])
+        MetadataColumns.build(metadatas).save(path)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, path=None, **kwargs):
+        if path is None:
+            raise ValueError("MmapVectorStore.from_texts needs the directory to write to as `path`")
+
+        texts = list(texts)
+        cls.write(path, texts, embedding.embed_documents(texts), metadatas or [{} for _ in texts])
+
+        return cls(path, embedding)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise TypeError("MmapVectorStore is read-only, rebuild the index to change it")
+
+    def _filtered_scores(self, query, filter):
+        # Scores only the partitions the filter allows, then drops rows failing the other keys
+        if PARTITION_KEY in filter:
+            ranges = [self.partitions[value] for value in filter[PARTITION_KEY] if value in self.partitions]
+        else:
+            ranges = [(0, len(self.vectors))]
+
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges] + [np.empty(0, dtype=np.int64)])
+        scores = np.concatenate([self.vectors[start:end] @ query for start, end in ranges]
+                                + [np.empty(0, dtype=np.float32)])
+
+        rest = {key: values for key, values in filter.items() if key != PARTITION_KEY}
+
+        if rest:
+            mask = self.columns.mask(rest, rows)
+            rows, scores = rows[mask], scores[mask]
+
+        return rows, scores
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        if len(self.vectors) == 0:
+            return []
+
+        # not in place, the caller's vector may already be a float32 array
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+
+        if filter:
+            rows, scores = self._filtered_scores(query, filter)
+        else:
+            rows, scores = np.arange(len(self.vectors)), self.vectors @ query
+
+        k = min(k, len(scores))
+
+        if k == 0:
+            return []
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(_to_document(self.chunks[rows[i]]), float(scores[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # scores are cosine similarities
+        return lambda score: (score + 1) / 2
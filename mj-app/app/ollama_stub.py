@@ -0,0 +1,110 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for Ollama's /api/generate and /api/tags, to run the server and its LLM pool without a GPU:
+#     python -m app.ollama_stub --port 11435 &
+#     python -m app.ollama_stub --port 11436 &
+#     OLLAMA_BASE_URLS=http://localhost:11435,http://localhost:11436 uvicorn app.server:app
+# The answer is derived from the prompt, so the same prompt always gets the same tokens. Generation takes
+# --prompt-ms plus --token-ms per token, and like Ollama a server runs at most --parallel generations at once.
+
+words = ["پاسخ", "پزشک", "به", "این", "سوال", "با", "توجه", "شرایط", "شما", "است", "و", "را", "توصیه", "می‌شود"]
+
+
+def stub_tokens(prompt, count):
+    seed = int(hashlib.sha1(prompt.encode('utf-8')).hexdigest(), 16)
+
+    return [words[(seed >> (4 * i)) % len(words)] + ' ' for i in range(count)]
+
+
+def make_handler(model, tokens, prompt_ms, token_ms, slots):
+
+    class OllamaStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_chunk(self, data):
+            line = json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path != '/api/tags':
+                self.send_json({'error': 'not found'}, 404)
+                return
+
+            self.send_json({'models': [{'name': f"{model}:latest"}]})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            if self.path != '/api/generate':
+                self.send_json({'error': 'not found'}, 404)
+                return
+
+            if request.get('model', model).split(':')[0] != model:
+                self.send_json({'error': f"model '{request['model']}' not found"}, 404)
+                return
+
+            answer = stub_tokens(request.get('prompt', ''), tokens)
+            # Ollama reports token counts with the last response, here words stand in for tokens
+            usage = {'prompt_eval_count': len(request.get('prompt', '').split()), 'eval_count': len(answer)}
+
+            with slots:
+                time.sleep(prompt_ms / 1000)
+
+                if not request.get('stream', True):
+                    time.sleep(token_ms * len(answer) / 1000)
+                    self.send_json({'model': model, 'response': ''.join(answer), 'done': True, **usage})
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                try:
+                    for token in answer:
+                        time.sleep(token_ms / 1000)
+                        self.send_chunk({'model': model, 'response': token, 'done': False})
+
+                    self.send_chunk({'model': model, 'response': '', 'done': True, **usage})
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading, as Ollama does the generation stops too
+                    self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return OllamaStubHandler
+
+
+def serve(port=11435, model='llama3.1', tokens=32, prompt_ms=50.0, token_ms=10.0, parallel=1):
+    server = ThreadingHTTPServer(('127.0.0.1', port),
+                                 make_handler(model, tokens, prompt_ms, token_ms, threading.Semaphore(parallel)))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a deterministic stand-in for the Ollama API")
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--model', default='llama3.1')
+    parser.add_argument('--tokens', type=int, default=32, help="tokens per answer")
+    parser.add_argument('--prompt-ms', type=float, default=50.0, help="time before the first token")
+    parser.add_argument('--token-ms', type=float, default=10.0, help="time per token")
+    parser.add_argument('--parallel', type=int, default=1, help="generations run at once, the rest wait")
+    args = parser.parse_args()
+
+    serve(args.port, args.model, args.tokens, args.prompt_ms, args.token_ms, args.parallel)
@@ -0,0 +1,234 @@
+import gc
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+from langchain_core.retrievers import BaseRetriever
+
+from app.index import file_checksum, prune_indexes
+
+# Seconds between checks of the FAQ file for changes, 0 leaves reloading to /admin/reload
+RELOAD_WATCH_INTERVAL = float(os.environ.get('RELOAD_WATCH_INTERVAL', 0))
+# Longest a replaced generation waits for its requests before it is let go anyway
+RELOAD_DRAIN_TIMEOUT = float(os.environ.get('RELOAD_DRAIN_TIMEOUT', 300))
+# Seconds between reads of the ingest log for chats posted to other workers, 0 turns it off
+INGEST_SYNC_INTERVAL = float(os.environ.get('INGEST_SYNC_INTERVAL', 1))
+
+logger = logging.getLogger(__name__)
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Generation:
+
+    def __init__(self, number, checksum, retriever, live):
+        self.number = number
+        self.checksum = checksum
+        self.retriever = retriever
+        self.live = live
+        # the index directory it serves from
+        self.path = getattr(retriever, 'path', None)
+        self.created = time.time()
+        self.active = 0
+        self.retired = False
+        self.drained = threading.Event()
+
+
+class IndexGenerations:
+    # The index the server answers from, replaced without a restart. reload() opens the index of the current FAQ
+    # file in a background thread, building it first when it does not exist yet, while the running generation keeps
+    # serving. Then it swaps the two: requests already in the old generation finish there, and it is released once
+    # the last one is done. One reload runs at a time and waits for that release, so at most two generations are
+    # ever held. open_generation() returns the retriever and the live segment of a new generation. With index_dir,
+    # older index directories are pruned once the old generation is released, see app.index.prune_indexes.
+
+    def __init__(self, faq_path, open_generation, drain_timeout=RELOAD_DRAIN_TIMEOUT, on_swap=None, index_dir=None):
+        self.faq_path = faq_path
+        self.index_dir = index_dir
+        self.open_generation = open_generation
+        self.drain_timeout = drain_timeout
+        self.on_swap = on_swap
+
+        self._lock = threading.Lock()
+        # held while a generation replays the ingest log and is swapped in, so no ingested chat is missed
+        self._ingest_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+        self.reloads = 0
+        self.last_reload = None
+        self.last_error = None
+        self.current = self._open(1, file_checksum(faq_path))
+
+    def _open(self, number, checksum):
+        retriever, live = self.open_generation()
+
+        if live is not None:
+            live.replay()
+
+        return Generation(number, checksum, retriever, live)
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            generation = self.current
+            generation.active += 1
+
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                generation.active -= 1
+
+                if generation.retired and generation.active == 0:
+                    generation.drained.set()
+
+    def ingest(self, chats):
+        with self._ingest_lock:
+            return self.current.live.add(chats)
+
+    @property
+    def reloading(self):
+        return self._reload_lock.locked()
+
+    def reload(self, force=False):
+        # Returns the new generation's number, or None when the FAQ file did not change or a reload is running
+        if not self._reload_lock.acquire(blocking=False):
+            return None
+
+        try:
+            checksum = file_checksum(self.faq_path)
+
+            if checksum == self.current.checksum and not force:
+                return None
+
+            start = time.perf_counter()
+            retriever, live = self.open_generation()
+
+            with self._ingest_lock:
+                if live is not None:
+                    live.replay()
+
+                with self._lock:
+                    old = self.current
+                    self.current = Generation(old.number + 1, checksum, retriever, live)
+                    old.retired = True
+
+                    if old.active == 0:
+                        old.drained.set()
+
+            if self.on_swap is not None:
+                self.on_swap()
+
+            drained = old.drained.wait(self.drain_timeout)
+            self.reloads += 1
+            self.last_reload = {'generation': self.current.number, 'seconds': time.perf_counter() - start,
+                                'drained': drained}
+            self.last_error = None
+
+            # requests that outlived the timeout still hold their own references
+            old.retriever = old.live = None
+            gc.collect()
+
+            if self.index_dir is not None:
+                # an old generation still in use keeps its directory until a later reload
+                exclude = [self.current.path] if drained else [self.current.path, old.path]
+                self.last_reload['pruned'] = prune_indexes(self.index_dir, exclude=exclude)
+
+            return self.current.number
+        except Exception as e:
+            # the current generation keeps serving
+            self.last_error = repr(e)
+            raise
+        finally:
+            self._reload_lock.release()
+
+    def reload_in_background(self, force=False):
+        if self.reloading:
+            return False
+
+        threading.Thread(target=self._reload_quietly, args=(force,), name='index-reload', daemon=True).start()
+
+        return True
+
+    def _reload_quietly(self, force=False):
+        try:
+            self.reload(force)
+        except Exception:
+            logger.exception("index reload failed, still serving generation %d", self.current.number)
+
+    def watch(self, interval=RELOAD_WATCH_INTERVAL):
+        # Polls the FAQ file and reloads when it changes. prepare_docs.py replaces it atomically, so a changed
+        # file is always a complete one.
+        if interval <= 0:
+            return
+
+        def poll():
+            stamp = file_stamp(self.faq_path)
+
+            while True:
+                time.sleep(interval)
+
+                try:
+                    current = file_stamp(self.faq_path)
+                except OSError:
+                    continue
+
+                # a change seen while a reload runs is picked up by the next poll
+                if current != stamp and not self.reloading:
+                    stamp = current
+                    self._reload_quietly()
+
+        threading.Thread(target=poll, name='index-watch', daemon=True).start()
+
+    def follow_ingest(self, interval=INGEST_SYNC_INTERVAL, on_ingest=None):
+        # Reads the chats other workers appended to the ingest log into the current generation, see app.live
+        if interval <= 0:
+            return
+
+        def poll():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    with self._ingest_lock:
+                        live = self.current.live
+                        added = live.sync() if live is not None else 0
+                except Exception:
+                    logger.exception("reading the ingest log failed")
+                    continue
+
+                if added and on_ingest is not None:
+                    on_ingest()
+
+        threading.Thread(target=poll, name='ingest-follow', daemon=True).start()
+
+    def stats(self):
+        current = self.current
+
+        return {
+            'generation': current.number,
+            'checksum': current.checksum,
+            'created': current.created,
+            'active_requests': current.active,
+            'reloading': self.reloading,
+            'reloads': self.reloads,
+            'last_reload': self.last_reload,
+            'last_error': self.last_error,
+        }
+
+
+class GenerationalRetriever(BaseRetriever):
+    # Runs every query on the current generation, and keeps it alive until the query is done
+
+    generations: Any
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        with self.generations.acquire() as generation:
+            return generation.retriever.invoke(query, **kwargs)
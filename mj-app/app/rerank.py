@@ -0,0 +1,103 @@
+import os
+import time
+from typing import Any
+
+from langchain_core.retrievers import BaseRetriever
+
+from app.metrics import span
+
+# Empty disables reranking. A small multilingual cross-encoder keeps the stage in the tens of milliseconds on CPU.
+RERANKER_MODEL = os.environ.get('RERANKER_MODEL', '')
+RERANK_MAX_CANDIDATES = int(os.environ.get('RERANK_MAX_CANDIDATES', 8))
+RERANK_TOP_N = int(os.environ.get('RERANK_TOP_N', 3))
+RERANK_BUDGET_MS = float(os.environ.get('RERANK_BUDGET_MS', 50))
+RERANK_MAX_LENGTH = int(os.environ.get('RERANK_MAX_LENGTH', 256))
+# Candidates scored even when the budget fits fewer, so the cost keeps being measured
+PROBE_SIZE = 2
+
+
+class Reranker:
+    # Scores (query, document) pairs with a cross-encoder in a single batch. A batch costs a fixed overhead plus a
+    # cost per candidate. Both are measured once at start-up, and the batches scored since then scale them to the
+    # current speed of the machine. The number of candidates is capped so that the batch stays within budget_ms,
+    # but at least PROBE_SIZE are scored, so a slow batch cannot turn reranking off: the next ones are timed and
+    # bring the limit back up.
+
+    def __init__(self, model_name=RERANKER_MODEL, max_candidates=RERANK_MAX_CANDIDATES, top_n=RERANK_TOP_N,
+                 budget_ms=RERANK_BUDGET_MS, max_length=RERANK_MAX_LENGTH):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        self.max_candidates = max(max_candidates, PROBE_SIZE)
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.last = {}
+
+        # the first call pays for lazy initialisation and is left out, then the best of a few batches at each end of
+        # the range gives the fixed and per-candidate cost of full-length documents
+        texts = [' '.join(['پاسخ'] * max_length)] * self.max_candidates
+        self._score('warm up', texts[:PROBE_SIZE])
+        small = min(self._score('warm up', texts[:PROBE_SIZE])[1] for _ in range(3))
+        large = min(self._score('warm up', texts)[1] for _ in range(3))
+
+        if self.max_candidates > PROBE_SIZE:
+            self.ms_per_candidate = max((large - small) / (self.max_candidates - PROBE_SIZE), 1e-3)
+        else:
+            self.ms_per_candidate = small / PROBE_SIZE
+
+        self.fixed_ms = max(small - self.ms_per_candidate * PROBE_SIZE, 0.0)
+        # exponential moving average of measured / predicted batch time
+        self.slowdown = 1.0
+
+    def _score(self, query, texts):
+        start = time.perf_counter()
+        scores = self.model.predict([(query, text) for text in texts], batch_size=len(texts))
+
+        return scores, (time.perf_counter() - start) * 1000
+
+    def predicted_ms(self, candidates):
+        return self.slowdown * (self.fixed_ms + self.ms_per_candidate * candidates)
+
+    def candidate_limit(self):
+        fit = int((self.budget_ms / self.slowdown - self.fixed_ms) / self.ms_per_candidate)
+
+        return max(PROBE_SIZE, min(self.max_candidates, fit))
+
+    def rerank(self, query, docs):
+        limit = self.candidate_limit()
+        candidates, rest = docs[:limit], docs[limit:]
+
+        if len(candidates) < 2:
+            return docs[:self.top_n]
+
+        predicted = self.predicted_ms(len(candidates))
+        scores, elapsed = self._score(query, [doc.page_content for doc in candidates])
+        self.slowdown = 0.8 * self.slowdown + 0.2 * self.slowdown * elapsed / max(predicted, 1e-3)
+        self.last = {'candidates': len(candidates), 'skipped': len(rest), 'ms': elapsed}
+
+        ranked = [doc for _, doc in sorted(zip(scores.tolist(), candidates), key=lambda pair: -pair[0])]
+
+        # candidates beyond the budget keep their retrieval order, behind the reranked ones
+        return (ranked + rest)[:self.top_n]
+
+    def stats(self):
+        return {
+            'candidate_limit': self.candidate_limit(),
+            'fixed_ms': self.fixed_ms,
+            'ms_per_candidate': self.ms_per_candidate,
+            'slowdown': self.slowdown,
+            'budget_ms': self.budget_ms,
+            'last': self.last,
+        }
+
+
+class RerankingRetriever(BaseRetriever):
+
+    retriever: BaseRetriever
+    reranker: Any
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        docs = self.retriever.invoke(query, **kwargs)
+
+        with span('rerank'):
+            return self.reranker.rerank(query, docs)
@@ -1,78 +1,91 @@
-import json
+import asyncio
+import hmac
+import os
 
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
-from langchain.docstore.document import Document
+from fastapi import Body, FastAPI, Header, HTTPException
+from fastapi.responses import RedirectResponse, StreamingResponse
 from langchain.prompts import ChatPromptTemplate
-from langchain.retrievers import ParentDocumentRetriever
-from langchain.storage import InMemoryStore
-from langchain_community.llms import Ollama
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.runnables import RunnableLambda
 from langserve import add_routes
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
 
-with open("../unique_faqs.json", "r") as fp:
-    faqs = json.load(fp)
+from app.answer_cache import SemanticCache, with_semantic_cache
+from app.context import CONTEXT_TOKEN_BUDGET, CompressingRetriever, ContextCompressor
+from app.embeddings import load_embeddings
+from app.filters import split_request
+from app.index import FAQ_PATH, INDEX_DIR, load_index
+from app.live import LiveSegment
+from app.llm import OllamaGenerator
+from app.metrics import RETRIEVED_DOCS, instrument_requests, profiled, span
+from app.reload import GenerationalRetriever, IndexGenerations
+from app.rerank import RERANKER_MODEL, Reranker, RerankingRetriever
+from app.serving import AdmissionLimiter, limit_requests, offload, retrieval_executor
+from app.streaming import StreamStats, stream_answer
 
+# Required by the /admin endpoints in an X-Admin-Token header, they refuse every request while it is unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
-def convert_to_document(faqs):
-    docs = []
+embeddings = load_embeddings()
 
-    for faq in faqs:
-        docs.append(Document(
-            page_content='\n\n'.join([faq['question']] + [answer['answer_text'] for answer in faq['answers']])))
-
-    return docs
 
+def open_generation():
+    # Chats posted by the crawler are searched next to the index until it is rebuilt with them, see app.live
+    live = LiveSegment(embeddings, FAQ_PATH)
 
-docs = convert_to_document(faqs)
+    # Opens the index prebuilt by `python -m app.index`, and only builds it when none matches the FAQ file
+    return load_index(FAQ_PATH, INDEX_DIR, embeddings, live=live), live
 
-model_kwargs = {'device': 'cuda', 'trust_remote_code': True}
 
-encode_kwargs = {}
+# A changed FAQ file is loaded into a new generation and swapped in without a restart, see app.reload
+generations = IndexGenerations(FAQ_PATH, open_generation, on_swap=lambda: answer_cache.invalidate(),
+                              index_dir=INDEX_DIR)
+generations.watch()
+# chats posted to the other workers, they clear this worker's answer cache too
+generations.follow_ingest(on_ingest=lambda: answer_cache.invalidate())
+retriever = GenerationalRetriever(generations=generations)
 
-hf = HuggingFaceEmbeddings(
-    model_name='paraphrase-multilingual-mpnet-base-v2',
-    model_kwargs=model_kwargs,
-    encode_kwargs=encode_kwargs
-)
+reranker = None
 
-separators = [
-    "\n\n",
-    ".",
-    " "
-]
-
-# This text splitter is used to create the child documents
-child_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=400,
-    chunk_overlap=100,
-    length_function=len,
-    is_separator_regex=False,
-    separators=separators
-)
+if RERANKER_MODEL:
+    reranker = Reranker()
+    retriever = RerankingRetriever(retriever=retriever, reranker=reranker)
 
-# The vectorstore to use to index the child chunks
-vectorstore = Chroma(
-    collection_name="full_documents", embedding_function=hf
-)
-
-# The storage layer for the parent documents
-store = InMemoryStore()
-retriever = ParentDocumentRetriever(
-    vectorstore=vectorstore,
-    docstore=store,
-    child_splitter=child_splitter,
-)
+compressor = None
 
-retriever.add_documents(docs, ids=None)
+if CONTEXT_TOKEN_BUDGET > 0:
+    # Drops repeated answers and caps the prompt size before it reaches the LLM
+    compressor = ContextCompressor()
+    retriever = CompressingRetriever(retriever=retriever, compressor=compressor)
 
 prompt = ChatPromptTemplate.from_template(
     "شما یک چت بات پزشکی هستید که برای پاسخ به سوالات پزشکی کاربران طراحی شده است. مجموعه‌ای از پرسش‌ها و پاسخ‌های مرتبط از یک مجموعه داده قابل اعتماد به شما ارائه می‌شود که توسط پزشک متخصص پاسخ داده می‌شود. وظیفه شما این است که تنها بر اساس این داده های ارائه شده پاسخ هایی ایجاد کنید. از هیچ دانش یا اطلاعات خارجی فراتر از مجموعه داده داده شده استفاده نکنید. نکات مهم: فقط از سوالات و پاسخ های ارائه شده برای ایجاد پاسخ استفاده کنید. اطمینان حاصل کنید که پاسخ ها دقیق و مرتبط با درخواست کاربر هستند. لحن حرفه ای و همدلانه خود را حفظ کنید.{context}")
 
-llm = Ollama(model="llama3.1")
+llm = OllamaGenerator()
+
+
+def retrieve(request):
+    # An optional specialty or doctor hint restricts retrieval to the answers of matching doctors
+    query, hints = split_request(request)
+
+    with span('retrieve'):
+        docs = retriever.invoke(query, **hints)
+
+    RETRIEVED_DOCS.observe(len(docs))
+
+    return docs
+
+
+# Retrieval is blocking, so async callers run it on the retrieval thread pool. With PROFILE_SAMPLE_RATE set, a share
+# of the retrievals runs under cProfile, see app.metrics.
+search = offload(RunnableLambda(profiled(retrieve)))
+
+# Repeated questions are answered from memory instead of running retrieval and generation again
+answer_cache = SemanticCache(
+    threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+    max_size=int(os.environ.get('ANSWER_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 3600)),
+    source=FAQ_PATH,
+)
 
 app = FastAPI(
     title="LangChain Server",
@@ -90,14 +103,113 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Bounded concurrency and queue depth for the chain, with a deadline per request
+limiter = AdmissionLimiter()
+limit_requests(app, '/doctor_yab', limiter)
+
+# Per-stage timings, token counts and cache hits at /metrics, in the Prometheus text format
+instrument_requests(app, '/doctor_yab')
+
+
 @app.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
+stream_stats = StreamStats()
+
+
+@app.get("/doctor_yab/sse")
+async def doctor_yab_sse(query: str, specialty: str = None, doctor: str = None):
+    # Server-sent events: one `token` event per generated token, then an `end` event with the request's timings
+    request = {'query': query, 'specialty': specialty, 'doctor': doctor}
+
+    return StreamingResponse(
+        stream_answer(request, search, prompt, llm, stream_stats, embeddings=embeddings, cache=answer_cache),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache'},
+    )
+
+
+@app.get("/streaming/stats")
+async def streaming_stats():
+    return stream_stats.stats()
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return answer_cache.stats()
+
+
+@app.get("/requests/stats")
+async def request_stats():
+    return limiter.stats()
+
+
+@app.get("/rerank/stats")
+async def rerank_stats():
+    return reranker.stats() if reranker is not None else {}
+
+
+@app.get("/context/stats")
+async def context_stats():
+    return compressor.stats() if compressor is not None else {}
+
+
+@app.get("/embeddings/stats")
+async def embedding_stats():
+    return embeddings.batcher.stats() if embeddings.batcher is not None else {}
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return llm.stats()
+
+
+@app.get("/ingest/stats")
+async def ingest_stats():
+    return generations.current.live.stats()
+
+
+@app.get("/index/stats")
+async def index_stats():
+    return generations.stats()
+
+
+def check_admin_token(token):
+    # fails closed: the server listens on every interface, and ingested chats end up in patients' answers
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="the admin endpoints are off until ADMIN_TOKEN is set")
+
+    if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        raise HTTPException(status_code=403)
+
+
+@app.post("/admin/reload")
+async def reload_index(force: bool = False, x_admin_token: str = Header('')):
+    # Loads the current FAQ file into a new index generation in the background, /index/stats tells when it is live
+    check_admin_token(x_admin_token)
+
+    return {'started': generations.reload_in_background(force), 'generation': generations.current.number}
+
+
+@app.post("/admin/ingest")
+async def ingest(chats: list = Body(..., embed=True), x_admin_token: str = Header('')):
+    # Scraped chats, as the crawler exports them, become retrievable without rebuilding the index
+    check_admin_token(x_admin_token)
+
+    added = await asyncio.get_running_loop().run_in_executor(retrieval_executor, generations.ingest, chats)
+
+    if added:
+        # cached answers were generated without the new answers
+        answer_cache.invalidate()
+
+    return {'chats': len(chats), 'answers_added': added}
+
+
 # Edit this to add the chain you want to add
 add_routes(app,
-           retriever | prompt | llm,
+           with_semantic_cache(search | prompt | llm, embeddings, answer_cache),
            path='/doctor_yab')
 
 if __name__ == "__main__":
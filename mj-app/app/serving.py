@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.responses import JSONResponse
+from langchain_core.runnables import RunnableLambda
+
+RETRIEVAL_WORKERS = int(os.environ.get('RETRIEVAL_WORKERS', 4))
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 16))
+MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', 64))
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 120))
+
+# Encoding and vector search hold the GIL or a native lock for most of their run, so they get a small pool of their
+# own instead of the event loop's default executor
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+
+
+def offload(runnable, executor=retrieval_executor):
+    # Same runnable, but ainvoke runs the blocking invoke on the given executor, in the caller's context so its
+    # spans land in the request's trace
+    async def ainvoke(input):
+        context = contextvars.copy_context()
+
+        return await asyncio.get_running_loop().run_in_executor(executor, context.run, runnable.invoke, input)
+
+    return RunnableLambda(runnable.invoke, afunc=ainvoke)
+
+
+class AdmissionLimiter:
+    # At most max_concurrency requests run at once and at most max_queue wait for a slot, the rest are turned away
+
+    def __init__(self, max_concurrency=MAX_CONCURRENT_REQUESTS, max_queue=MAX_QUEUED_REQUESTS):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            return False
+
+        self.waiting += 1
+
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+        }
+
+
+def limit_requests(app, path_prefix, limiter, timeout=REQUEST_TIMEOUT):
+    # Requests under path_prefix get a slot from the limiter (503 when the queue is full) and a deadline covering
+    # the wait plus the time to the first response byte (504 when it passes). Streamed bodies keep their slot
+    # until the last chunk is sent.
+
+    @app.middleware("http")
+    async def admission(request, call_next):
+        if not request.url.path.startswith(path_prefix):
+            return await call_next(request)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        try:
+            admitted = await asyncio.wait_for(limiter.acquire(), timeout)
+        except asyncio.TimeoutError:
+            admitted = False
+            limiter.timed_out += 1
+
+        if not admitted:
+            return JSONResponse({'detail': "server is busy, retry later"}, status_code=503, headers={'Retry-After': '1'})
+
+        try:
+            response = await asyncio.wait_for(call_next(request), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            limiter.release()
+            limiter.timed_out += 1
+            return JSONResponse({'detail': "request timed out"}, status_code=504)
+        except BaseException:
+            limiter.release()
+            raise
+
+        body = response.body_iterator
+
+        async def release_when_sent():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                limiter.release()
+
+        response.body_iterator = release_when_sent()
+
+        return response
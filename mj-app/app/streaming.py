@@ -0,0 +1,107 @@
+import json
+import time
+from collections import deque
+
+from app.filters import scope_key, split_request
+from app.metrics import current_trace, span
+
+
+class StreamStats:
+    # Latency of the last `window` streamed answers, per stage
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.samples = {
+            'retrieval_ms': deque(maxlen=window),
+            'time_to_first_token_ms': deque(maxlen=window),
+            'total_ms': deque(maxlen=window),
+            'tokens_per_sec': deque(maxlen=window),
+        }
+
+    def record(self, metrics):
+        self.requests += 1
+
+        for name, samples in self.samples.items():
+            if metrics.get(name) is not None:
+                samples.append(metrics[name])
+
+    def stats(self):
+        summary = {'requests': self.requests}
+
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+
+            summary[name] = {
+                'p50': ordered[len(ordered) // 2] if ordered else None,
+                'p95': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] if ordered else None,
+                'mean': sum(ordered) / len(ordered) if ordered else None,
+            }
+
+        return summary
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_answer(request, retriever, prompt, llm, stats, embeddings=None, cache=None):
+    # Runs retriever | prompt | llm by hand so each stage can be timed, and sends every token as an SSE event as
+    # soon as Ollama produces it. The last event carries this request's metrics.
+    start = time.perf_counter()
+    query, hints = split_request(request)
+    vector = None
+
+    if cache is not None:
+        vector = await embeddings.aembed_query(query)
+        cached = cache.lookup(vector, scope_key(hints))
+
+        if cached is not None:
+            yield sse_event('token', {'token': cached})
+            yield sse_event('end', {'cached': True, 'total_ms': (time.perf_counter() - start) * 1000})
+            return
+
+    docs = await retriever.ainvoke(request)
+    retrieved = time.perf_counter()
+
+    with span('prompt'):
+        prompt_value = await prompt.ainvoke(docs)
+
+    first_token = None
+    tokens = []
+
+    async for token in llm.astream(prompt_value):
+        if first_token is None:
+            first_token = time.perf_counter()
+
+        tokens.append(token)
+        yield sse_event('token', {'token': token})
+
+    end = time.perf_counter()
+
+    if cache is not None:
+        cache.put(vector, ''.join(tokens), scope_key(hints))
+
+    # Ollama sends one token per chunk, so chunks stand in for tokens
+    generation = end - first_token if first_token is not None else 0
+    metrics = {
+        'cached': False,
+        'retrieved_docs': len(docs),
+        'context_tokens': sum(doc.metadata.get('tokens', 0) for doc in docs),
+        'context_tokens_saved': sum(doc.metadata.get('tokens_original', 0) - doc.metadata.get('tokens', 0)
+                                    for doc in docs),
+        'retrieval_ms': (retrieved - start) * 1000,
+        'time_to_first_token_ms': (first_token - start) * 1000 if first_token is not None else None,
+        'total_ms': (end - start) * 1000,
+        'tokens': len(tokens),
+        'tokens_per_sec': (len(tokens) - 1) / generation if generation > 0 else None,
+    }
+
+    stats.record(metrics)
+
+    trace = current_trace.get()
+
+    if trace is not None:
+        # every stage timed while answering, including the ones inside retrieval
+        metrics['stages_ms'] = trace.summary()
+
+    yield sse_event('end', metrics)
@@ -0,0 +1,133 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from faq_common.normalize import normalize_text
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+
+    def __init__(self, root, model_name):
+        self.model_name = model_name
+        self.path = os.path.join(root, model_name.replace('/', '__'))
+        self.dim = None
+        self.rows = {}
+        self.vectors = None
+        self._keys_offset = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.refresh()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _lock(self, operation):
+        with open(self._file('lock'), 'w') as fp:
+            fcntl.flock(fp, operation)
+            yield
+
+    def _load(self):
+        # Reads only the keys appended since the last call and remaps the vector file.
+        if self.dim is None:
+            if not os.path.exists(self._file('meta.json')):
+                return
+
+            with open(self._file('meta.json')) as fp:
+                self.dim = json.load(fp)['dim']
+
+        if not os.path.exists(self._file('keys.txt')):
+            return
+
+        with open(self._file('keys.txt'), 'rb') as fp:
+            fp.seek(self._keys_offset)
+            data = fp.read()
+
+        self._keys_offset += len(data)
+
+        for key in data.decode('ascii').split():
+            self.rows[key] = len(self.rows)
+
+        if self.rows:
+            self.vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r',
+                                     shape=(len(self.rows), self.dim))
+
+    def refresh(self):
+        with self._lock(fcntl.LOCK_SH):
+            self._load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, text):
+        return text_key(text) in self.rows
+
+    def get(self, text):
+        # A read-only view into the memory map, nothing is copied
+        row = self.rows.get(text_key(text))
+
+        return None if row is None else self.vectors[row]
+
+    def put(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        with self._lock(fcntl.LOCK_EX):
+            if self.dim is None and not os.path.exists(self._file('meta.json')):
+                with open(self._file('meta.json'), 'w') as fp:
+                    json.dump({'model': self.model_name, 'dim': vectors.shape[1]}, fp)
+
+            self._load()
+
+            new = {}
+
+            for text, vector in zip(texts, vectors):
+                key = text_key(text)
+
+                if key not in self.rows and key not in new:
+                    new[key] = vector
+
+            if not new:
+                return
+
+            vectors_file = self._file('vectors.f32')
+
+            # drop rows a crashed writer may have left without a key
+            if os.path.exists(vectors_file):
+                os.truncate(vectors_file, len(self.rows) * self.dim * 4)
+
+            with open(vectors_file, 'ab') as fp:
+                fp.write(np.stack(list(new.values())).astype(np.float32).tobytes())
+
+            with open(self._file('keys.txt'), 'a') as fp:
+                fp.write(''.join(key + '\n' for key in new))
+
+            self._load()
+
+    def encode(self, texts, encode_fn):
+        # Embeds texts through the cache: encode_fn is only called with the texts that were never seen, in their
+        # normalized form, so every spelling variant sharing a key also gets the same vector.
+        self.refresh()
+
+        keys = [text_key(text) for text in texts]
+        missing = {}
+
+        for key, text in zip(keys, texts):
+            if key not in self.rows:
+                missing.setdefault(key, normalize_text(text))
+
+        if missing:
+            missing_texts = list(missing.values())
+            self.put(missing_texts, encode_fn(missing_texts))
+
+        if not keys:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+
+        return np.asarray(self.vectors[[self.rows[key] for key in keys]])
@@ -0,0 +1,88 @@
+import os
+
+# torch: the sentence-transformers model as published, fp32, on the selected device
+# onnx-int8: the same model exported to ONNX with dynamically quantized int8 weights, CPU only
+BACKENDS = ['torch', 'onnx-int8']
+
+ONNX_EXPORT_DIR = os.environ.get('ONNX_EXPORT_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'faq-common', 'onnx'))
+QUANTIZED_FILE = 'onnx/model_qint8_avx2.onnx'
+
+
+def select_device(device='auto'):
+    if device != 'auto':
+        return device
+
+    import torch
+
+    if torch.cuda.is_available():
+        return 'cuda'
+
+    if getattr(torch.backends, 'mps', None) is not None and torch.backends.mps.is_available():
+        return 'mps'
+
+    return 'cpu'
+
+
+def has_onnx_support():
+    # the export needs optimum's onnxruntime integration as well as onnxruntime, both come with the `onnx` extra
+    try:
+        import onnxruntime  # noqa: F401
+        import optimum.onnxruntime  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+
+def select_backend(backend='auto', device='cpu'):
+    if backend != 'auto':
+        return backend
+
+    return 'onnx-int8' if device == 'cpu' and has_onnx_support() else 'torch'
+
+
+def encoder_name(model_name, backend):
+    # Vectors from different backends differ slightly, so caches and indexes are keyed on this name
+    return model_name if backend == 'torch' else f"{model_name}-{backend}"
+
+
+def _load_quantized(model_name, threads=None, export_dir=ONNX_EXPORT_DIR):
+    import onnxruntime
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    path = os.path.join(export_dir, model_name.replace('/', '__'))
+
+    if not os.path.exists(os.path.join(path, QUANTIZED_FILE)):
+        # One-off: export the fp32 model to ONNX, then quantize its weights to int8 next to it
+        model = SentenceTransformer(model_name, backend='onnx', device='cpu')
+        model.save(path)
+        export_dynamic_quantized_onnx_model(model, 'avx2', path)
+
+    session_options = onnxruntime.SessionOptions()
+
+    if threads:
+        session_options.intra_op_num_threads = threads
+
+    return SentenceTransformer(path, backend='onnx', device='cpu', model_kwargs={
+        'file_name': QUANTIZED_FILE,
+        'provider': 'CPUExecutionProvider',
+        'session_options': session_options,
+    })
+
+
+def load_encoder(model_name, backend='auto', device='auto', threads=None):
+    # Returns the SentenceTransformer and the backend actually used
+    from sentence_transformers import SentenceTransformer
+
+    device = select_device(device)
+    backend = select_backend(backend, device)
+
+    if backend == 'onnx-int8':
+        return _load_quantized(model_name, threads), backend
+
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+
+    return SentenceTransformer(model_name, device=device), backend
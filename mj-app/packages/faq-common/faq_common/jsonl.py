@@ -0,0 +1,190 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# JSON Lines, one record per line, is the format passed between the crawler, prepare_docs.py and the server. Every
+# stage reads and writes one record at a time, so memory does not grow with the corpus, and a reader can follow a
+# file that is still being written. Files holding a single JSON array (the old chats.json / unique_faqs.json) are
+# still read, but have to be loaded whole.
+
+
+def encode_record(record) -> bytes:
+    return json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def is_json_array(path) -> bool:
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(4096), b''):
+            block = block.lstrip()
+
+            if block:
+                return block.startswith(b'[')
+
+    return False
+
+
+def read_records(path, follow=False, poll_interval=0.5, idle_timeout=10.0):
+    # Yields the records of the file in order. With follow=True it keeps waiting for lines appended by a running
+    # writer, and stops once the file has not grown for idle_timeout seconds.
+    if not follow and is_json_array(path):
+        with open(path) as fp:
+            yield from json.load(fp)
+
+        return
+
+    with open(path, 'rb') as fp:
+        pending = b''
+        idle_since = time.monotonic()
+
+        while True:
+            line = fp.readline()
+
+            if line.endswith(b'\n'):
+                line, pending = pending + line, b''
+                idle_since = time.monotonic()
+
+                if line.strip():
+                    yield json.loads(line)
+
+                continue
+
+            # a partial line is kept until the writer finishes it
+            pending += line
+
+            if not follow or time.monotonic() - idle_since >= idle_timeout:
+                break
+
+            if line:
+                idle_since = time.monotonic()
+
+            time.sleep(poll_interval)
+
+        if pending.strip():
+            yield json.loads(pending)
+
+
+class RecordFile:
+    # Random access to the records of a JSON Lines file: only the byte offset of each line is kept in memory, a
+    # record is parsed when it is asked for. Records can be replaced or appended like in a list, the changes stay
+    # in memory until the file is rewritten.
+
+    def __init__(self, path):
+        self.path = path
+        offsets = [0]
+
+        with open(path, 'rb') as fp:
+            for line in fp:
+                if line.strip():
+                    offsets.append(offsets[-1] + len(line))
+                else:
+                    offsets[-1] += len(line)
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.size = len(offsets) - 1
+        self.patches = {}
+        self._fp = open(path, 'rb')
+
+    def __len__(self):
+        return self.size
+
+    def _row(self, row):
+        if not -self.size <= row < self.size:
+            raise IndexError(row)
+
+        return row % self.size
+
+    def __getitem__(self, row):
+        row = self._row(row)
+
+        if row in self.patches:
+            return self.patches[row]
+
+        self._fp.seek(self.offsets[row])
+
+        return json.loads(self._fp.read(self.offsets[row + 1] - self.offsets[row]))
+
+    def __setitem__(self, row, record):
+        self.patches[self._row(row)] = record
+
+    def append(self, record):
+        self.patches[self.size] = record
+        self.size += 1
+
+    def __iter__(self):
+        for row in range(self.size):
+            yield self[row]
+
+    def close(self):
+        self._fp.close()
+
+
+def open_records(path):
+    # A sequence over the records of either format, lazy for JSON Lines
+    if is_json_array(path):
+        with open(path) as fp:
+            return json.load(fp)
+
+    return RecordFile(path)
+
+
+class JsonlWriter:
+    # With atomic=True the records go to a temporary file that replaces `path` on close, so readers never see a
+    # partial file and `path` itself can be read while its replacement is written. Otherwise every record is
+    # flushed as soon as it is written, for readers following the file, and append=True adds to an existing file.
+
+    def __init__(self, path, atomic=True, append=False):
+        self.path = path
+        self.atomic = atomic and not append
+        self.count = 0
+        atomic = self.atomic
+
+        if atomic:
+            fd, self._tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                             dir=os.path.dirname(os.path.abspath(path)))
+            # mkstemp creates the file readable by its owner only
+            os.chmod(self._tmp, 0o644)
+            self._fp = os.fdopen(fd, 'wb')
+        else:
+            self._fp = open(path, 'ab' if append else 'wb')
+
+    def write(self, record):
+        self._fp.write(encode_record(record))
+        self.count += 1
+
+        if not self.atomic:
+            self._fp.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self._fp.close()
+
+        if self.atomic:
+            os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._fp.close()
+
+        if self.atomic:
+            os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_records(path, records, atomic=True):
+    with JsonlWriter(path, atomic=atomic) as writer:
+        writer.write_all(records)
+
+    return writer.count
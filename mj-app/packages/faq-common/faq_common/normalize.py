@@ -0,0 +1,329 @@
+import re
+
+# Character normalization for Persian text, shared by the crawler, prepare_docs.py and the server
+
+char_mappings = {
+        "٥": "5",
+        "А": "a",
+        "В": "b",
+        "Е": "e",
+        "Н": "h",
+        "Р": "P",
+        "С": "C",
+        "Т": "T",
+        "а": "a",
+        "г": "r",
+        "е": "e",
+        "к": "k",
+        "м": "m",
+        "о": "o",
+        "р": "p",
+        "ڈ": "د",
+        "ڇ": "چ",
+        # Persian numbers (will be raplaced by english one)
+        "۰": "0",
+        "۱": "1",
+        "۲": "2",
+        "۳": "3",
+        "۴": "4",
+        "۵": "5",
+        "۶": "6",
+        "۷": "7",
+        "۸": "8",
+        "۹": "9",
+        ".": ".",
+        # Arabic numbers (will be raplaced by english one)
+        "٠": "0",
+        "١": "1",
+        "٢": "2",
+        "٣": "3",
+        "٤": "4",
+        "٥": "5",
+        "٦": "6",
+        "٧": "7",
+        "٨": "8",
+        "٩": "9",
+        # Special Arabic Characters (will be replaced by persian one)
+        "ك": "ک",
+        "ى": "ی",
+        "ي": "ی",
+        "ؤ": "و",
+        "ئ": "ی",
+        "إ": "ا",
+        "أ": "ا",
+        "آ": "ا",
+        "ة": "ه",
+        "ء": "ی",
+        # French alphabet (will be raplaced by english one)
+        "à": "a",
+        "ä": "a",
+        "ç": "c",
+        "é": "e",
+        "è": "e",
+        "ê": "e",
+        "ë": "e",
+        "î": "i",
+        "ï": "i",
+        "ô": "o",
+        "ù": "u",
+        "û": "u",
+        "ü": "u",
+        # zero-width unicode
+        "\u200c": "",
+        "\u200b": "",
+        "\ufe0f": "",
+        "\ufeff": "",
+        "\n": "",
+        # Camma (will be replaced by dots for floating point numbers)
+        ",": ".",
+        # And (will be replaced by dots for floating point numbers)
+        "&": " and ",
+        # Vowels (will be removed)
+        "ّ": "",  # tashdid
+        "َ": "",  # a
+        "ِ": "",  # e
+        "ُ": "",  # o
+        "ـ": "",  # tatvil
+        # Spaces
+        "‍": "",  # 0x9E -> ZERO WIDTH JOINER
+        "‌": " ",  # 0x9D -> ZERO WIDTH NON-JOINER
+        # Arabic Presentation Forms-A (will be replaced by persian one)
+        "ﭐ": "ا",
+        "ﭑ": "ا",
+        "ﭖ": "پ",
+        "ﭗ": "پ",
+        "ﭘ": "پ",
+        "ﭙ": "پ",
+        "ﭞ": "ت",
+        "ﭟ": "ت",
+        "ﭠ": "ت",
+        "ﭡ": "ت",
+        "ﭺ": "چ",
+        "ﭻ": "چ",
+        "ﭼ": "چ",
+        "ﭽ": "چ",
+        "ﮊ": "ژ",
+        "ﮋ": "ژ",
+        "ﮎ": "ک",
+        "ﮏ": "ک",
+        "ﮐ": "ک",
+        "ﮑ": "ک",
+        "ﮒ": "گ",
+        "ﮓ": "گ",
+        "ﮔ": "گ",
+        "ﮕ": "گ",
+        "ﮤ": "ه",
+        "ﮥ": "ه",
+        "ﮦ": "ه",
+        "ﮪ": "ه",
+        "ﮫ": "ه",
+        "ﮬ": "ه",
+        "ﮭ": "ه",
+        "ﮮ": "ی",
+        "ﮯ": "ی",
+        "ﮰ": "ی",
+        "ﮱ": "ی",
+        "ﯼ": "ی",
+        "ﯽ": "ی",
+        "ﯾ": "ی",
+        "ﯿ": "ی",
+        # Arabic Presentation Forms-B (will be removed)
+        "ﹰ": "",
+        "ﹱ": "",
+        "ﹲ": "",
+        "ﹳ": "",
+        "ﹴ": "",
+        "﹵": "",
+        "ﹶ": "",
+        "ﹷ": "",
+        "ﹸ": "",
+        "ﹹ": "",
+        "ﹺ": "",
+        "ﹻ": "",
+        "ﹼ": "",
+        "ﹽ": "",
+        "ﹾ": "",
+        "ﹿ": "",
+        # Arabic Presentation Forms-B (will be replaced by persian one)
+        "ﺀ": "ی",
+        "ﺁ": "ا",
+        "ﺂ": "ا",
+        "ﺃ": "ا",
+        "ﺄ": "ا",
+        "ﺅ": "و",
+        "ﺆ": "و",
+        "ﺇ": "ا",
+        "ﺈ": "ا",
+        "ﺉ": "ی",
+        "ﺊ": "ی",
+        "ﺋ": "ی",
+        "ﺌ": "ی",
+        "ﺍ": "ا",
+        "ﺎ": "ا",
+        "ﺏ": "ب",
+        "ﺐ": "ب",
+        "ﺑ": "ب",
+        "ﺒ": "ب",
+        "ﺓ": "ه",
+        "ﺔ": "ه",
+        "ﺕ": "ت",
+        "ﺖ": "ت",
+        "ﺗ": "ت",
+        "ﺘ": "ت",
+        "ﺙ": "ث",
+        "ﺚ": "ث",
+        "ﺛ": "ث",
+        "ﺜ": "ث",
+        "ﺝ": "ج",
+        "ﺞ": "ج",
+        "ﺟ": "ج",
+        "ﺠ": "ج",
+        "ﺡ": "ح",
+        "ﺢ": "ح",
+        "ﺣ": "ح",
+        "ﺤ": "ح",
+        "ﺥ": "خ",
+        "ﺦ": "خ",
+        "ﺧ": "خ",
+        "ﺨ": "خ",
+        "ﺩ": "د",
+        "ﺪ": "د",
+        "ﺫ": "ذ",
+        "ﺬ": "ذ",
+        "ﺭ": "ر",
+        "ﺮ": "ر",
+        "ﺯ": "ز",
+        "ﺰ": "ز",
+        "ﺱ": "س",
+        "ﺲ": "س",
+        "ﺳ": "س",
+        "ﺴ": "س",
+        "ﺵ": "ش",
+        "ﺶ": "ش",
+        "ﺷ": "ش",
+        "ﺸ": "ش",
+        "ﺹ": "ص",
+        "ﺺ": "ص",
+        "ﺻ": "ص",
+        "ﺼ": "ص",
+        "ﺽ": "ض",
+        "ﺾ": "ض",
+        "ﺿ": "ض",
+        "ﻀ": "ض",
+        "ﻁ": "ط",
+        "ﻂ": "ط",
+        "ﻃ": "ط",
+        "ﻄ": "ط",
+        "ﻅ": "ظ",
+        "ﻆ": "ظ",
+        "ﻇ": "ظ",
+        "ﻈ": "ظ",
+        "ﻉ": "ع",
+        "ﻊ": "ع",
+        "ﻋ": "ع",
+        "ﻌ": "ع",
+        "ﻍ": "غ",
+        "ﻎ": "غ",
+        "ﻏ": "غ",
+        "ﻐ": "غ",
+        "ﻑ": "ف",
+        "ﻒ": "ف",
+        "ﻓ": "ف",
+        "ﻔ": "ف",
+        "ﻕ": "ق",
+        "ﻖ": "ق",
+        "ﻗ": "ق",
+        "ﻘ": "ق",
+        "ﻙ": "ک",
+        "ﻚ": "ک",
+        "ﻛ": "ک",
+        "ﻜ": "ک",
+        "ﻝ": "ل",
+        "ﻞ": "ل",
+        "ﻟ": "ل",
+        "ﻠ": "ل",
+        "ﻡ": "م",
+        "ﻢ": "م",
+        "ﻣ": "م",
+        "ﻤ": "م",
+        "ﻥ": "ن",
+        "ﻦ": "ن",
+        "ﻧ": "ن",
+        "ﻨ": "ن",
+        "ﻩ": "ه",
+        "ﻪ": "ه",
+        "ﻫ": "ه",
+        "ﻬ": "ه",
+        "ﻭ": "و",
+        "ﻮ": "و",
+        "ﻯ": "ی",
+        "ﻰ": "ی",
+        "ﻱ": "ی",
+        "ﻲ": "ی",
+        "ﻳ": "ی",
+        "ﻴ": "ی",
+        "ﻵ": "لا",
+        "ﻶ": "لا",
+        "ﻷ": "لا",
+        "ﻸ": "لا",
+        "ﻹ": "لا",
+        "ﻺ": "لا",
+        "ﻻ": "لا",
+        "ﻼ": "لا",
+        # sukun
+        "\u0652": "",
+    }
+
+translation_table = dict((ord(a), b) for a, b in char_mappings.items())
+
+# str.translate looks every character up in translation_table, while a precompiled character class skips the
+# characters that need no change (nearly all of them in crawled text) in C and only calls back on the rest.
+# Same result, several times faster, see benchmarks/normalize.py.
+char_pattern = re.compile('[' + ''.join(re.escape(char) for char in char_mappings) + ']')
+
+# Keys compare text modulo whitespace, so a newline separates words instead of gluing them together
+key_mappings = dict(char_mappings, **{'\n': ' '})
+
+
+def _replace_char(match):
+    return char_mappings[match.group()]
+
+
+def _replace_key_char(match):
+    return key_mappings[match.group()]
+
+
+def clean_persian_text(text: str) -> str:
+    # Map invalid characters with replacement to valid characters.
+    return char_pattern.sub(_replace_char, text)
+
+
+def normalize_text(text: str) -> str:
+    # The canonical form used for keys (caches, dedup, lookups): cleaned, whitespace collapsed
+    return ' '.join(char_pattern.sub(_replace_key_char, text).split())
+
+
+def _batch(function, texts):
+    # Columns such as dr_name or dr_exp repeat a handful of values, each distinct one is normalized once
+    done = {}
+
+    return [done[text] if text in done else done.setdefault(text, function(text)) for text in texts]
+
+
+def clean_batch(texts):
+    return _batch(clean_persian_text, texts)
+
+
+def normalize_batch(texts):
+    return _batch(normalize_text, texts)
+
+
+def clean_records(records, fields, batch=clean_batch):
+    # Copies of the records with the given fields normalized one column at a time
+    records = [dict(record) for record in records]
+
+    for field in fields:
+        for record, value in zip(records, batch([record[field] for record in records])):
+            record[field] = value
+
+    return records
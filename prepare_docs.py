@@ -1,50 +1,159 @@
-import json
+import argparse
+import os
+from functools import lru_cache
 
-import sentence_transformers.util as util
+import torch
 from langchain.output_parsers import ResponseSchema, StructuredOutputParser
 from langchain_core.documents import Document
-from langchain_core.load import dumps
 from langchain_ollama.llms import OllamaLLM
-from sentence_transformers import SentenceTransformer
-from tqdm.autonotebook import tqdm
 
-with open('scrape_chats/chats.json') as f:
-    faqs = json.load(f)
+from faq_common.embedding_cache import EmbeddingCache
+from faq_common.encoders import BACKENDS, encoder_name, load_encoder, select_backend, select_device
+from faq_common.jsonl import open_records, read_records, write_records
+from faq_common.normalize import normalize_batch
 
-sbert_model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
-questions = [faq['question'] for faq in faqs]
-embeddings = sbert_model.encode(questions, convert_to_tensor=True, show_progress_bar=True, normalize_embedding=False)
+from dedup import (ann_neighbours, answered, build_state, chat_summary, cluster, current_versions, dedup_faqs,
+                   neighbour_pairs, neighbour_recall, similar_pairs, update_faqs)
 
-unique_faqs = []
-seen_questions = set()
+MODEL_NAME = 'paraphrase-multilingual-mpnet-base-v2'
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', '.embedding_cache')
 
+parser = argparse.ArgumentParser(description="Merge near-duplicate chats into unique FAQs")
+parser.add_argument('--chats', default='scrape_chats/chats.jsonl', help="crawler output, JSON Lines")
+parser.add_argument('--output', default='unique_faqs.jsonl', help="unique FAQs, JSON Lines")
+parser.add_argument('--follow', action='store_true',
+                    help="start embedding while the crawler is still writing --chats, dedup once it stops growing")
+parser.add_argument('--embed-batch', type=int, default=256, help="questions embedded at a time while reading --chats")
+parser.add_argument('--threshold', type=float, default=0.85, help="cosine similarity above which two questions merge")
+parser.add_argument('--block-size', type=int, default=1024, help="rows/columns per similarity tile, bounds memory")
+parser.add_argument('--backend', choices=['exact', 'ann'], default='exact', help="all-pairs tiles or an HNSW index")
+parser.add_argument('--top-k', type=int, default=32, help="ann: candidates scored per question")
+parser.add_argument('--ef', type=int, default=64, help="ann: HNSW search breadth, higher is slower and more accurate")
+parser.add_argument('--recall-sample', type=int, default=1000, help="ann: questions checked against the exact path, 0 to skip")
+parser.add_argument('--incremental', action='store_true',
+                    help="only embed new or changed chats and merge them into the existing --output")
+parser.add_argument('--state', default='dedup_state.pt', help="embeddings and centroids kept between runs")
+parser.add_argument('--embedding-backend', choices=['auto'] + BACKENDS, default='auto',
+                    help="auto picks onnx-int8 on CPU-only machines when onnxruntime and optimum are installed")
+parser.add_argument('--device', default='auto', help="cpu, cuda, mps or auto")
+parser.add_argument('--threads', type=int, default=None, help="CPU threads for the encoder")
+args = parser.parse_args()
+
+device = select_device(args.device)
+backend = select_backend(args.embedding_backend, device)
+encoder = encoder_name(MODEL_NAME, backend)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, encoder)
+
+
+@lru_cache(maxsize=None)
+def load_model():
+    # only loaded when the cache misses
+    return load_encoder(MODEL_NAME, backend, device, args.threads)[0]
+
+
+def embed(texts):
+    # questions are normalized the same way as server queries, so Arabic ی/ک and ZWNJ variants embed alike
+    vectors = embedding_cache.encode(normalize_batch(texts),
+                                     lambda missing: load_model().encode(missing, show_progress_bar=True))
+
+    return torch.from_numpy(vectors)
+
+
+def find_pairs(embeddings):
+    if args.backend == 'ann':
+        neighbours = ann_neighbours(embeddings, threshold=args.threshold, top_k=args.top_k, ef=args.ef)
+
+        if args.recall_sample > 0:
+            recall = neighbour_recall(embeddings, neighbours, threshold=args.threshold, sample_size=args.recall_sample,
+                                      block_size=args.block_size)
+            print(f"ann recall against the exact path on {min(args.recall_sample, len(embeddings))} questions: {recall:.3f}")
+
+        return neighbour_pairs(neighbours)
+
+    return similar_pairs(embeddings, threshold=args.threshold, block_size=args.block_size, show_progress=True)
+
+
+def read_chats(path, known=None):
+    # Streams the chats once, keeping only their summaries, and embeds their questions batch by batch as they are
+    # read so that with --follow the encoder works alongside the crawler. Incremental crawls append new versions of
+    # a chat to the same file, the last one wins. With `known` (key -> version), chats whose current version is
+    # known are left out. Returns the rows of the chats kept and their summaries, in file order.
+    known = known or {}
+    latest, batch = {}, []
+
+    for row, chat in enumerate(read_records(path, follow=args.follow)):
+        summary = chat_summary(chat)
+
+        if known.get(summary['key']) == summary['version']:
+            latest.pop(summary['key'], None)
+            continue
+
+        latest[summary['key']] = (row, summary)
+        batch.append(chat['question'])
+
+        if len(batch) == args.embed_batch:
+            embed(batch)
+            batch = []
+
+    if batch:
+        embed(batch)
+
+    kept = sorted(latest.values(), key=lambda item: item[0])
+
+    return [row for row, _ in kept], [summary for _, summary in kept]
+
+
+state = None
+
+if args.incremental:
+    if os.path.exists(args.state) and os.path.exists(args.output):
+        state = torch.load(args.state)
+
+        if state['model'] != encoder:
+            print(f"{args.state} was built with {state['model']}, rebuilding from scratch")
+            state = None
+        elif 'keys' not in state:
+            print(f"{args.state} does not tell chats apart, rebuilding from scratch")
+            state = None
+    else:
+        print("no previous run found, rebuilding from scratch")
+
+delta = None
+
+if state is None:
+    rows, chats = read_chats(args.chats)
+    # every question is in the embedding cache by now
+    embeddings = embed([chat['question'] for chat in chats])
+
+    # chats are read back one cluster at a time while unique FAQs are written out. With --follow the file may have
+    # grown since it was embedded, so everything is sized from the chats read, not from the file.
+    chat_count = len(chats)
+    clusters = answered(chats, cluster(chat_count, find_pairs(embeddings)))
+    records = open_records(args.chats)
+    unique_count = write_records(args.output, dedup_faqs(records, [[rows[i] for i in ids] for ids in clusters]))
+    state = build_state(encoder, chats, embeddings, clusters)
+else:
+    # the output is rewritten as a whole, only the FAQs touched by the new chats are held in memory
+    unique_faqs = open_records(args.output)
 
-def merge_faq(base_faq, similars):
-    for ans in [a for f in similars for a in f['answers']]:
-        base_faq['answers'].append(ans)
+    current = current_versions(state)
+    rows, chats = read_chats(args.chats, known={key: state['versions'][row] for key, row in current.items()})
+    records = open_records(args.chats)
+    faqs = [records[row] for row in rows]
+    chat_count = len(faqs)
 
-    return base_faq
+    if faqs:
+        embeddings = embed([chat['question'] for chat in chats])
+        clusters = cluster(len(faqs), find_pairs(embeddings))
+    else:
+        embeddings, clusters = torch.empty(0, state['embeddings'].shape[1]), []
 
-
-for i, faq in tqdm(enumerate(faqs), total=len(faqs)):
-
-    if faq['question'] not in seen_questions:
-
-        seen_questions.add(faq['question'])
-
-        similar_ids = []
-
-        for j in range(i + 1, len(faqs)):
-
-            if util.pytorch_cos_sim(embeddings[i], embeddings[j]) > 0.85:
-                similar_ids.append(j)
-
-                seen_questions.add(faqs[j]['question'])
-
-        if len(similar_ids) > 0:
-            unique_faqs.append(merge_faq(faq.copy(), [faqs[j] for j in similar_ids]))
-        else:
-            unique_faqs.append(faq)
+    # chats merged by an earlier run that changed since have their old answers taken out of their FAQs, then the
+    # new versions are merged like new chats. FAQs left without answers are dropped.
+    kept, changed = update_faqs(unique_faqs, state, current, faqs, embeddings, clusters, threshold=args.threshold,
+                                block_size=args.block_size)
+    delta = [{'id': i, 'faq': unique_faqs[kept[i]]} for i in changed]
+    unique_count = write_records(args.output, (unique_faqs[i] for i in kept))
 
 # Alternative scheme for summarizing questions using chain which was replaced due to lack of resources
 # ## # Initialize the Ollama model
@@ -75,8 +184,11 @@ for i, faq in tqdm(enumerate(faqs), total=len(faqs)):
 # # summarize similar questions
 # chain.invoke({'questions': '\n'.join(questions)})  ###
 
-print(f"we have {len(faqs)} chats and after this process we have {len(unique_faqs)} documents")
+print(f"we have {chat_count} chats and after this process we have {unique_count} documents")
+
+if delta is not None:
+    delta_path = os.path.splitext(args.output)[0] + '.delta.jsonl'
+    print(f"{len(delta)} documents were added or updated, see {delta_path}")
+    write_records(delta_path, delta)
 
-with open("unique_faqs.json", "w") as fp:
-    string_representation = dumps(unique_faqs)
-    fp.write(string_representation)
+torch.save(state, args.state)
@@ -0,0 +1,49 @@
+import json
+import os
+
+
+class CrawlState:
+    # What an interrupted crawl already did, kept in a JSON file until the crawl finishes: the feeds it exported to,
+    # the number of listing pages, the listing pages whose chats were all scraped and the chats already exported.
+
+    def __init__(self, path):
+        self.path = path
+        self.feeds = None
+        self.last_page = None
+        self.pages_done = set()
+        self.chats_done = set()
+
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+
+            # not recorded by older state files
+            self.feeds = data.get('feeds')
+            self.last_page = data['last_page']
+            self.pages_done = set(data['pages_done'])
+            self.chats_done = set(data['chats_done'])
+
+    @property
+    def resuming(self):
+        return bool(self.pages_done or self.chats_done)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+
+        with open(tmp, 'w') as fp:
+            json.dump({
+                'feeds': self.feeds,
+                'last_page': self.last_page,
+                'pages_done': sorted(self.pages_done),
+                'chats_done': sorted(self.chats_done),
+            }, fp)
+
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.last_page = None
+        self.pages_done = set()
+        self.chats_done = set()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
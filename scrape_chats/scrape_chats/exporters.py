@@ -0,0 +1,16 @@
+from scrapy.exporters import BaseItemExporter
+
+from faq_common.jsonl import encode_record
+
+
+class JsonLinesExporter(BaseItemExporter):
+    # Writes items exactly as faq_common.jsonl reads them, one per line, flushed as soon as it is exported so that
+    # `prepare_docs.py --follow` can start on the first chats while the crawl is still running
+
+    def __init__(self, file, **kwargs):
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+
+    def export_item(self, item):
+        self.file.write(encode_record(dict(self.get_serialized_fields(item))))
+        self.file.flush()
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import time
+
+
+def content_hash(data):
+    if not isinstance(data, (str, bytes)):
+        data = json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    return hashlib.sha1(data).hexdigest()
+
+
+class FingerprintStore:
+    # What the last crawls saw of every chat, by URL: a hash of its entry on the listing page, a hash of the
+    # scraped chat, its number of answers and when it was last downloaded. Kept in a JSON file between crawls.
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.chats = {}
+
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.chats = json.load(fp)
+
+    def __len__(self):
+        return len(self.chats)
+
+    def get(self, url):
+        return self.chats.get(url)
+
+    def listing_unchanged(self, url, listing, max_age):
+        # True when the chat was downloaded less than max_age seconds ago and its listing entry looks the same
+        fingerprint = self.chats.get(url)
+
+        return (fingerprint is not None and fingerprint['listing'] == listing
+                and self.clock() - fingerprint['checked'] < max_age)
+
+    def update(self, url, listing, item):
+        # Records a downloaded chat, returns 'new', 'updated' or 'unchanged'
+        fingerprint = self.chats.get(url)
+        # the url is the key already, and fingerprints made before items carried it stay valid
+        content = content_hash({key: value for key, value in item.items() if key != 'url'})
+
+        self.chats[url] = {
+            'listing': listing,
+            'content': content,
+            'answers': len(item['answers']),
+            'checked': self.clock(),
+        }
+
+        if fingerprint is None:
+            return 'new'
+
+        return 'unchanged' if fingerprint['content'] == content else 'updated'
+
+    def save(self):
+        tmp = self.path + '.tmp'
+
+        with open(tmp, 'w') as fp:
+            json.dump(self.chats, fp, ensure_ascii=False)
+
+        os.replace(tmp, self.path)
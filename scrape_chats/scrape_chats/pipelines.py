@@ -1,13 +1,81 @@
-# Define your item pipelines here
-#
-# Don't forget to add your pipeline to the ITEM_PIPELINES setting
-# See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+import json
+import time
 
-
-# useful for handling different item types with a single interface
+import scrapy
 from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
 
 
 class ScrapeChatsPipeline:
-    def process_item(self, item, spider):
+    # Posts scraped chats in small batches to the server's /admin/ingest endpoint (INGEST_URL), which embeds them,
+    # merges them into the FAQs of the live index and makes them retrievable without a rebuild. The spider already
+    # normalized the text. Items go on to the feed unchanged, so chats.jsonl and prepare_docs.py keep working.
+    #
+    #     scrapy crawl chats -a incremental=1 -s INGEST_URL=http://localhost:8000/admin/ingest
+    #
+    # The posts are scheduled like any other request, ahead of the pages, and the last batch goes out when the
+    # spider runs out of pages. Ingesting the same chat twice adds nothing, so failed posts are simply retried.
+
+    def __init__(self, crawler, url, batch_size, max_wait, token):
+        self.crawler = crawler
+        self.url = url
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.token = token
+        self.batch = []
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        url = crawler.settings.get('INGEST_URL')
+
+        if not url:
+            raise NotConfigured
+
+        pipeline = cls(crawler, url, crawler.settings.getint('INGEST_BATCH_SIZE'),
+                       crawler.settings.getfloat('INGEST_MAX_WAIT'), crawler.settings.get('INGEST_TOKEN'))
+        crawler.signals.connect(pipeline.spider_idle, signal=signals.spider_idle)
+
+        return pipeline
+
+    def process_item(self, item, spider=None):
+        if not self.batch:
+            self.started = time.monotonic()
+
+        self.batch.append(ItemAdapter(item).asdict())
+
+        # a batch also goes out once its first chat has waited max_wait seconds, so a slow crawl still ingests
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.started >= self.max_wait:
+            self.flush()
+
         return item
+
+    def spider_idle(self, spider=None):
+        if self.batch:
+            self.flush()
+            raise DontCloseSpider
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        headers = {'Content-Type': 'application/json'}
+
+        if self.token:
+            headers['X-Admin-Token'] = self.token
+
+        self.crawler.engine.crawl(scrapy.Request(
+            self.url, method='POST', headers=headers, dont_filter=True, priority=2,
+            body=json.dumps({'chats': batch}, ensure_ascii=False).encode('utf-8'),
+            callback=self.ingested, errback=self.failed, cb_kwargs={'size': len(batch)},
+            meta={'dont_obey_robotstxt': True, 'dont_cache': True},
+        ))
+
+    def ingested(self, response, size):
+        stats = self.crawler.stats
+        stats.inc_value('ingest/chats', size)
+        stats.inc_value('ingest/answers_added', json.loads(response.text)['answers_added'])
+
+    def failed(self, failure):
+        size = failure.request.cb_kwargs['size']
+        self.crawler.spider.logger.warning(f"ingest of {size} chats failed: {failure.value!r}")
+        self.crawler.stats.inc_value('ingest/failed', size)
@@ -0,0 +1,98 @@
+import argparse
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlsplit
+
+from scrapy.exceptions import NotConfigured
+
+# Recorded pages let the spider run against a local server instead of doctor-yab.ir. Record a crawl once:
+#     scrapy crawl chats -a limit=5 -s RECORD_DIR=recorded
+# then replay it, with a delay per response that stands in for the real round-trip:
+#     python -m scrape_chats.recording --dir recorded --port 8001 --delay 0.2
+#     scrapy crawl chats -a limit=5 -a base_url=http://localhost:8001/faq/
+
+
+def recorded_path(root, url):
+    # one flat file per path and query string, the host is not part of it
+    parts = urlsplit(url)
+    name = parts.path.strip('/') + ('?' + parts.query if parts.query else '')
+
+    return os.path.join(root, quote(name, safe='') + '.html')
+
+
+class RecordResponsesMiddleware:
+    # Downloader middleware saving every successful response body under RECORD_DIR
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        root = crawler.settings.get('RECORD_DIR')
+
+        if not root:
+            raise NotConfigured
+
+        return cls(root)
+
+    def process_response(self, request, response, spider):
+        if response.status == 200:
+            with open(recorded_path(self.root, response.url), 'wb') as fp:
+                fp.write(response.body)
+
+        return response
+
+
+def make_handler(root, delay):
+
+    class RecordedPageHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = recorded_path(root, self.path)
+            time.sleep(delay)
+
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+
+            # pages carry their file's mtime as Last-Modified, so conditional requests can be tried locally
+            modified = int(os.path.getmtime(path))
+            since = self.headers.get('If-Modified-Since')
+
+            if since is not None and parsedate_to_datetime(since).timestamp() >= modified:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            with open(path, 'rb') as fp:
+                body = fp.read()
+
+            self.send_response(200)
+            self.send_header('Last-Modified', formatdate(modified, usegmt=True))
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RecordedPageHandler
+
+
+def serve(root, port=8001, delay=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(root, delay))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded Doctor-Yab pages to the spider")
+    parser.add_argument('--dir', default='recorded')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds to wait before every response")
+    args = parser.parse_args()
+
+    serve(args.dir, args.port, args.delay)
@@ -20,14 +20,15 @@ NEWSPIDER_MODULE = "scrape_chats.spiders"
 ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+# Listing pages are requested all at once, this and the per-domain limit bound how many are in flight
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 #DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
 #CONCURRENT_REQUESTS_PER_IP = 16
 
 # Disable cookies (enabled by default)
@@ -50,9 +51,10 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "scrape_chats.middlewares.ScrapeChatsDownloaderMiddleware": 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    # saves pages for scrape_chats.recording when RECORD_DIR is set, does nothing otherwise
+    "scrape_chats.recording.RecordResponsesMiddleware": 543,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -62,32 +64,60 @@ ROBOTSTXT_OBEY = True
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "scrape_chats.pipelines.ScrapeChatsPipeline": 300,
-#}
+ITEM_PIPELINES = {
+    # posts chats to the server's /admin/ingest when INGEST_URL is set, does nothing otherwise
+    "scrape_chats.pipelines.ScrapeChatsPipeline": 300,
+}
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-#AUTOTHROTTLE_ENABLED = True
+AUTOTHROTTLE_ENABLED = True
 # The initial download delay
-#AUTOTHROTTLE_START_DELAY = 5
+AUTOTHROTTLE_START_DELAY = 0.5
 # The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY = 60
+AUTOTHROTTLE_MAX_DELAY = 10
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
-#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+AUTOTHROTTLE_TARGET_CONCURRENCY = 4.0
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Chat pages are cached and revalidated with If-None-Match / If-Modified-Since when the site sends validators,
+# an unchanged page then costs a 304. Listing pages bypass the cache (see ChatsSpider.listing_request).
+HTTPCACHE_ENABLED = True
+HTTPCACHE_POLICY = "scrapy.extensions.httpcache.RFC2616Policy"
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = "httpcache"
+HTTPCACHE_IGNORE_HTTP_CODES = [429, 500, 502, 503, 504]
+HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
+
+# Chats are exported as JSON Lines, the format shared with prepare_docs.py and the server (faq_common.jsonl)
+FEED_EXPORTERS = {
+    "jsonl": "scrape_chats.exporters.JsonLinesExporter",
+}
+FEEDS = {
+    "chats.jsonl": {"format": "jsonl", "overwrite": True},
+}
+
+# Progress of the running crawl, an interrupted crawl resumes from it (see ChatsSpider)
+CRAWL_STATE_FILE = "crawl_state.json"
+
+# Hashes of every chat seen so far, for incremental crawls (-a incremental=1)
+FINGERPRINT_FILE = "fingerprints.json"
+# Chats whose listing entry looks unchanged are still downloaded again after this many days
+INCREMENTAL_RECHECK_DAYS = 7
+
+# Server endpoint the pipeline sends scraped chats to, e.g. http://localhost:8000/admin/ingest
+INGEST_URL = ""
+# Chats per request, and the longest a chat waits for its batch to fill up (seconds)
+INGEST_BATCH_SIZE = 16
+INGEST_MAX_WAIT = 2.0
+# Sent as X-Admin-Token, must match the server's ADMIN_TOKEN
+INGEST_TOKEN = ""
@@ -1,320 +1,186 @@
-from pathlib import Path
+from urllib.parse import parse_qs, urlsplit, urlunsplit
 
 import scrapy
+from scrapy.settings import SETTINGS_PRIORITIES
+from faq_common.normalize import clean_batch, clean_records
+
+from scrape_chats.crawl_state import CrawlState
+from scrape_chats.fingerprints import FingerprintStore, content_hash
 
 valid_chars = [
     " ", "ا", "ب", "ت", "ث", "ج", "ح", "خ", "د", "ذ", "ر", "ز", "س", "ش", "ص", "ض", "ط", "ظ", "ع", "غ", "ف", "ق",
     "ل", "م", "ن", "ه", "و", "پ", "چ", "ژ", "ک", "گ", "ی", ]
 
-char_mappings = {
-        "٥": "5",
-        "А": "a",
-        "В": "b",
-        "Е": "e",
-        "Н": "h",
-        "Р": "P",
-        "С": "C",
-        "Т": "T",
-        "а": "a",
-        "г": "r",
-        "е": "e",
-        "к": "k",
-        "м": "m",
-        "о": "o",
-        "р": "p",
-        "ڈ": "د",
-        "ڇ": "چ",
-        # Persian numbers (will be raplaced by english one)
-        "۰": "0",
-        "۱": "1",
-        "۲": "2",
-        "۳": "3",
-        "۴": "4",
-        "۵": "5",
-        "۶": "6",
-        "۷": "7",
-        "۸": "8",
-        "۹": "9",
-        ".": ".",
-        # Arabic numbers (will be raplaced by english one)
-        "٠": "0",
-        "١": "1",
-        "٢": "2",
-        "٣": "3",
-        "٤": "4",
-        "٥": "5",
-        "٦": "6",
-        "٧": "7",
-        "٨": "8",
-        "٩": "9",
-        # Special Arabic Characters (will be replaced by persian one)
-        "ك": "ک",
-        "ى": "ی",
-        "ي": "ی",
-        "ؤ": "و",
-        "ئ": "ی",
-        "إ": "ا",
-        "أ": "ا",
-        "آ": "ا",
-        "ة": "ه",
-        "ء": "ی",
-        # French alphabet (will be raplaced by english one)
-        "à": "a",
-        "ä": "a",
-        "ç": "c",
-        "é": "e",
-        "è": "e",
-        "ê": "e",
-        "ë": "e",
-        "î": "i",
-        "ï": "i",
-        "ô": "o",
-        "ù": "u",
-        "û": "u",
-        "ü": "u",
-        # zero-width unicode
-        "\u200c": "",
-        "\u200b": "",
-        "\ufe0f": "",
-        "\ufeff": "",
-        "\n": "",
-        # Camma (will be replaced by dots for floating point numbers)
-        ",": ".",
-        # And (will be replaced by dots for floating point numbers)
-        "&": " and ",
-        # Vowels (will be removed)
-        "ّ": "",  # tashdid
-        "َ": "",  # a
-        "ِ": "",  # e
-        "ُ": "",  # o
-        "ـ": "",  # tatvil
-        # Spaces
-        "‍": "",  # 0x9E -> ZERO WIDTH JOINER
-        "‌": " ",  # 0x9D -> ZERO WIDTH NON-JOINER
-        # Arabic Presentation Forms-A (will be replaced by persian one)
-        "ﭐ": "ا",
-        "ﭑ": "ا",
-        "ﭖ": "پ",
-        "ﭗ": "پ",
-        "ﭘ": "پ",
-        "ﭙ": "پ",
-        "ﭞ": "ت",
-        "ﭟ": "ت",
-        "ﭠ": "ت",
-        "ﭡ": "ت",
-        "ﭺ": "چ",
-        "ﭻ": "چ",
-        "ﭼ": "چ",
-        "ﭽ": "چ",
-        "ﮊ": "ژ",
-        "ﮋ": "ژ",
-        "ﮎ": "ک",
-        "ﮏ": "ک",
-        "ﮐ": "ک",
-        "ﮑ": "ک",
-        "ﮒ": "گ",
-        "ﮓ": "گ",
-        "ﮔ": "گ",
-        "ﮕ": "گ",
-        "ﮤ": "ه",
-        "ﮥ": "ه",
-        "ﮦ": "ه",
-        "ﮪ": "ه",
-        "ﮫ": "ه",
-        "ﮬ": "ه",
-        "ﮭ": "ه",
-        "ﮮ": "ی",
-        "ﮯ": "ی",
-        "ﮰ": "ی",
-        "ﮱ": "ی",
-        "ﯼ": "ی",
-        "ﯽ": "ی",
-        "ﯾ": "ی",
-        "ﯿ": "ی",
-        # Arabic Presentation Forms-B (will be removed)
-        "ﹰ": "",
-        "ﹱ": "",
-        "ﹲ": "",
-        "ﹳ": "",
-        "ﹴ": "",
-        "﹵": "",
-        "ﹶ": "",
-        "ﹷ": "",
-        "ﹸ": "",
-        "ﹹ": "",
-        "ﹺ": "",
-        "ﹻ": "",
-        "ﹼ": "",
-        "ﹽ": "",
-        "ﹾ": "",
-        "ﹿ": "",
-        # Arabic Presentation Forms-B (will be replaced by persian one)
-        "ﺀ": "ی",
-        "ﺁ": "ا",
-        "ﺂ": "ا",
-        "ﺃ": "ا",
-        "ﺄ": "ا",
-        "ﺅ": "و",
-        "ﺆ": "و",
-        "ﺇ": "ا",
-        "ﺈ": "ا",
-        "ﺉ": "ی",
-        "ﺊ": "ی",
-        "ﺋ": "ی",
-        "ﺌ": "ی",
-        "ﺍ": "ا",
-        "ﺎ": "ا",
-        "ﺏ": "ب",
-        "ﺐ": "ب",
-        "ﺑ": "ب",
-        "ﺒ": "ب",
-        "ﺓ": "ه",
-        "ﺔ": "ه",
-        "ﺕ": "ت",
-        "ﺖ": "ت",
-        "ﺗ": "ت",
-        "ﺘ": "ت",
-        "ﺙ": "ث",
-        "ﺚ": "ث",
-        "ﺛ": "ث",
-        "ﺜ": "ث",
-        "ﺝ": "ج",
-        "ﺞ": "ج",
-        "ﺟ": "ج",
-        "ﺠ": "ج",
-        "ﺡ": "ح",
-        "ﺢ": "ح",
-        "ﺣ": "ح",
-        "ﺤ": "ح",
-        "ﺥ": "خ",
-        "ﺦ": "خ",
-        "ﺧ": "خ",
-        "ﺨ": "خ",
-        "ﺩ": "د",
-        "ﺪ": "د",
-        "ﺫ": "ذ",
-        "ﺬ": "ذ",
-        "ﺭ": "ر",
-        "ﺮ": "ر",
-        "ﺯ": "ز",
-        "ﺰ": "ز",
-        "ﺱ": "س",
-        "ﺲ": "س",
-        "ﺳ": "س",
-        "ﺴ": "س",
-        "ﺵ": "ش",
-        "ﺶ": "ش",
-        "ﺷ": "ش",
-        "ﺸ": "ش",
-        "ﺹ": "ص",
-        "ﺺ": "ص",
-        "ﺻ": "ص",
-        "ﺼ": "ص",
-        "ﺽ": "ض",
-        "ﺾ": "ض",
-        "ﺿ": "ض",
-        "ﻀ": "ض",
-        "ﻁ": "ط",
-        "ﻂ": "ط",
-        "ﻃ": "ط",
-        "ﻄ": "ط",
-        "ﻅ": "ظ",
-        "ﻆ": "ظ",
-        "ﻇ": "ظ",
-        "ﻈ": "ظ",
-        "ﻉ": "ع",
-        "ﻊ": "ع",
-        "ﻋ": "ع",
-        "ﻌ": "ع",
-        "ﻍ": "غ",
-        "ﻎ": "غ",
-        "ﻏ": "غ",
-        "ﻐ": "غ",
-        "ﻑ": "ف",
-        "ﻒ": "ف",
-        "ﻓ": "ف",
-        "ﻔ": "ف",
-        "ﻕ": "ق",
-        "ﻖ": "ق",
-        "ﻗ": "ق",
-        "ﻘ": "ق",
-        "ﻙ": "ک",
-        "ﻚ": "ک",
-        "ﻛ": "ک",
-        "ﻜ": "ک",
-        "ﻝ": "ل",
-        "ﻞ": "ل",
-        "ﻟ": "ل",
-        "ﻠ": "ل",
-        "ﻡ": "م",
-        "ﻢ": "م",
-        "ﻣ": "م",
-        "ﻤ": "م",
-        "ﻥ": "ن",
-        "ﻦ": "ن",
-        "ﻧ": "ن",
-        "ﻨ": "ن",
-        "ﻩ": "ه",
-        "ﻪ": "ه",
-        "ﻫ": "ه",
-        "ﻬ": "ه",
-        "ﻭ": "و",
-        "ﻮ": "و",
-        "ﻯ": "ی",
-        "ﻰ": "ی",
-        "ﻱ": "ی",
-        "ﻲ": "ی",
-        "ﻳ": "ی",
-        "ﻴ": "ی",
-        "ﻵ": "لا",
-        "ﻶ": "لا",
-        "ﻷ": "لا",
-        "ﻸ": "لا",
-        "ﻹ": "لا",
-        "ﻺ": "لا",
-        "ﻻ": "لا",
-        "ﻼ": "لا",
-        # sukun
-        "\u0652": "",
-    }
-
-translation_table = dict((ord(a), b) for a, b in char_mappings.items())
-
-def clean_persian_text(text: str) -> str:
-    # Map invalid characters with replacement to valid characters.
-    # apply the translation table to the text
-    return text.translate(translation_table)
-
 class ChatsSpider(scrapy.Spider):
+    # Reads page 1 of the FAQ listing to learn how many pages there are, then requests the remaining ones all at
+    # once (`?page=N`) and lets CONCURRENT_REQUESTS decide how many are in flight. Progress is kept in
+    # CRAWL_STATE_FILE: an interrupted crawl started again skips the listing pages and chats it already finished,
+    # and appends to its feeds instead of overwriting them, even ones given with -O. A crawl started again with
+    # other feeds than the interrupted one starts over instead, since those feeds miss the chats already exported.
+    # The file is removed once a crawl finishes.
+    #
+    # Every downloaded chat is fingerprinted in FINGERPRINT_FILE. With -a incremental=1 only new or changed chats
+    # are exported, appended to the feeds of the earlier crawls, and a chat whose listing entry did not change is
+    # not downloaded at all unless it was last checked more than INCREMENTAL_RECHECK_DAYS ago. Rechecks go through
+    # the HTTP cache, so they become conditional requests when the site sends validators. Items carry their chat's
+    # `url`, which prepare_docs.py uses to keep only the last version of a chat.
+    #
+    #     scrapy crawl chats -a limit=0                                   every page
+    #     scrapy crawl chats -a limit=0 -a incremental=1                  nightly recrawl
+    #     scrapy crawl chats -a base_url=http://localhost:8001/faq/       against scrape_chats.recording
     name = "chats"
-    start_urls = [
-        "https://doctor-yab.ir/faq/?page=1"
-    ]
+    base_url = "https://doctor-yab.ir/faq/"
+    save_every = 25
 
     def __init__(self, **kwargs):
 
+            # listing pages to crawl, 0 for all of them
             self.page_limit = int(kwargs.get('limit', 2))
+            self.incremental = kwargs.get('incremental', '0') not in ('0', 'false', '')
+            self.pending = {}
+            self.scheduled = set()
+            self.updates = 0
 
             super().__init__(**kwargs)  # python3
 
-    def parse(self, response):
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.crawl_state = CrawlState(crawler.settings.get('CRAWL_STATE_FILE'))
+        spider.fingerprints = FingerprintStore(crawler.settings.get('FINGERPRINT_FILE'))
+        spider.recheck_after = crawler.settings.getfloat('INCREMENTAL_RECHECK_DAYS') * 24 * 3600
+
+        feeds = crawler.settings.getdict('FEEDS')
+        # an incremental crawl only exports new and changed chats, they go after the ones already exported
+        append = spider.incremental
+
+        if spider.crawl_state.resuming:
+            if spider.crawl_state.feeds is None or sorted(feeds) == spider.crawl_state.feeds:
+                # keep the chats the interrupted run already exported
+                append = True
+            else:
+                spider.logger.warning("Not resuming the interrupted crawl: it exported to %s, this run to %s",
+                                      spider.crawl_state.feeds, sorted(feeds))
+                spider.crawl_state.clear()
+
+        if append:
+            # also when -O asks to overwrite: -o/-O outrank the spider's settings, so the change is made at the
+            # priority FEEDS was set with
+            priority = max(SETTINGS_PRIORITIES['spider'], crawler.settings.getpriority('FEEDS'))
+            crawler.settings.set('FEEDS', {uri: dict(options, overwrite=False) for uri, options in feeds.items()},
+                                 priority=priority)
+
+        spider.crawl_state.feeds = sorted(feeds)
+
+        return spider
+
+    def page_url(self, page):
+        return f"{self.base_url}?page={page}"
+
+    def rebase(self, url):
+        # links to the live site point at base_url's host instead, so recorded pages can be served locally
+        base = urlsplit(self.base_url)
+
+        return urlunsplit(urlsplit(url)._replace(scheme=base.scheme, netloc=base.netloc))
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
+
+    def listing_request(self, url, page):
+        # listing pages change with every new question, they are never served from the HTTP cache
+        return scrapy.Request(url, callback=self.parse, cb_kwargs={'page': page}, meta={'dont_cache': True})
+
+    def start_requests(self):
+        # Scrapy < 2.13 only calls this one
+        yield self.listing_request(self.page_url(1), 1)
+
+    def last_page(self, response):
+        links = response.css("ul.pagination a::attr(href), li.PagedList-skipToLast a::attr(href)").getall()
+        pages = [int(page) for href in links for page in parse_qs(urlsplit(href).query).get('page', [])
+                 if page.isdigit()]
+
+        return max(pages, default=None)
+
+    def parse(self, response, page):
+
+        chats = []
 
         for chat in response.css("ul.questions li"):
 
-            post_link = response.urljoin(chat.css("h3 a::attr(href)").get())
+            post_link = self.rebase(response.urljoin(chat.css("h3 a::attr(href)").get()))
             answered = chat.css("i.fa-check").get() is not None
+            listing = content_hash(chat.get())
+
+            if self.incremental and self.fingerprints.listing_unchanged(post_link, listing, self.recheck_after):
+                self.crawler.stats.inc_value('incremental/skipped')
+                continue
 
-            if answered:
-                yield scrapy.Request(post_link, callback=self.parse_chat)
+            # the listing shifts as questions are added, the same chat can show up on two pages
+            if answered and post_link not in self.crawl_state.chats_done and post_link not in self.scheduled:
+                self.scheduled.add(post_link)
+                chats.append((post_link, listing))
 
+        if chats:
+            self.pending[page] = {post_link for post_link, _ in chats}
+        else:
+            self.crawl_state.pages_done.add(page)
+
+        for post_link, listing in chats:
+            # chats go first, so items keep flowing while the listing fans out
+            # max-age=0 makes the HTTP cache revalidate a cached page instead of trusting its heuristic freshness
+            yield scrapy.Request(post_link, callback=self.parse_chat, priority=1,
+                                 headers={'Cache-Control': 'max-age=0'},
+                                 cb_kwargs={'page': page, 'chat': post_link, 'listing': listing})
+
+        if page == 1:
+            last_page = self.last_page(response)
+
+            if last_page is not None:
+                if self.page_limit > 0:
+                    last_page = min(last_page, self.page_limit)
+
+                self.crawl_state.last_page = last_page
+
+                for next_page in range(2, last_page + 1):
+                    if next_page not in self.crawl_state.pages_done:
+                        yield self.listing_request(self.page_url(next_page), next_page)
+
+                return
+
+        if self.crawl_state.last_page is not None:
+            return
+
+        # no pager to read the page count from: follow the next links one page at a time
         next_page = response.css("li.PagedList-skipToNext a::attr(href)").get()
 
-        if next_page is not None and self.page_limit > 1:
-                self.page_limit -= 1
-                next_page = response.urljoin(next_page)
-                yield scrapy.Request(next_page, callback=self.parse)
+        if next_page is not None and (self.page_limit == 0 or page < self.page_limit):
+                next_page = self.rebase(response.urljoin(next_page))
+                yield self.listing_request(next_page, page + 1)
+
+    def done(self, page, chat):
+        self.crawl_state.chats_done.add(chat)
+        self.pending[page].discard(chat)
 
-    def parse_chat(self, response):
+        if not self.pending[page]:
+            del self.pending[page]
+            self.crawl_state.pages_done.add(page)
+
+        self.updates += 1
+
+        if self.updates % self.save_every == 0:
+            self.crawl_state.save()
+            self.fingerprints.save()
+
+    def closed(self, reason):
+        self.fingerprints.save()
+
+        if reason == 'finished':
+            self.crawl_state.clear()
+        else:
+            self.crawl_state.save()
+
+    def parse_chat(self, response, page, chat, listing):
 
         title = response.css("div>h1::text").get().strip()
 
@@ -330,15 +196,26 @@ class ChatsSpider(scrapy.Spider):
 
             answers.append(
                 {
-                    'dr_name': clean_persian_text(dr_name),
-                    'dr_exp': clean_persian_text(dr_exp),
-                    'answer_text': clean_persian_text(answer_text),
+                    'dr_name': dr_name,
+                    'dr_exp': dr_exp,
+                    'answer_text': answer_text,
                 }
             )
 
-        yield {
-            'title': clean_persian_text(title),
-            'question': clean_persian_text(question),
-            'answers': answers,
+        title, question = clean_batch([title, question])
+
+        item = {
+            'url': chat,
+            'title': title,
+            'question': question,
+            'answers': clean_records(answers, ['dr_name', 'dr_exp', 'answer_text']),
         }
 
+        change = self.fingerprints.update(chat, listing, item)
+        self.crawler.stats.inc_value(f'incremental/{change}')
+
+        if change != 'unchanged' or not self.incremental:
+            yield item
+
+        self.done(page, chat)
+
@@ -0,0 +1,91 @@
+import json
+
+import torch
+
+from dedup import (answered, build_state, chat_key, chat_summary, cluster, current_versions, dedup_faqs,
+                   similar_pairs, update_faqs)
+
+VECTORS = {
+    'q1': [1.0, 0.0, 0.0, 0.0],
+    'q1 again': [0.95, 0.31, 0.0, 0.0],
+    'q2': [0.0, 0.0, 1.0, 0.0],
+    'q3': [0.0, 0.0, 0.0, 1.0],
+}
+
+
+def chat(question, *answers):
+    return {'url': f'/chat/{question}', 'question': question,
+            'answers': [{'dr_name': 'dr', 'dr_exp': 'exp', 'answer_text': text} for text in answers]}
+
+
+def embed(chats):
+    return torch.tensor([VECTORS[chat['question']] for chat in chats])
+
+
+def latest(chats):
+    # what prepare_docs.read_chats keeps: the last version of every chat, in the order they were last written
+    rows = {chat_key(chat): row for row, chat in enumerate(chats)}
+
+    return [chats[row] for row in sorted(rows.values())]
+
+
+def full_run(chats):
+    chats = latest(chats)
+    summaries = [chat_summary(chat) for chat in chats]
+    embeddings = embed(chats)
+    clusters = answered(summaries, cluster(len(chats), similar_pairs(embeddings)))
+
+    return list(dedup_faqs(chats, clusters)), build_state('model', summaries, embeddings, clusters)
+
+
+def incremental_run(unique_faqs, state, chats):
+    current = current_versions(state)
+    known = {key: state['versions'][row] for key, row in current.items()}
+    faqs = [chat for chat in latest(chats) if known.get(chat_key(chat)) != chat_summary(chat)['version']]
+    embeddings = embed(faqs)
+
+    unique_faqs = list(unique_faqs)
+    kept, changed = update_faqs(unique_faqs, state, current, faqs, embeddings,
+                                cluster(len(faqs), similar_pairs(embeddings)))
+
+    return [unique_faqs[i] for i in kept]
+
+
+def canonical(faqs):
+    # FAQs come out in a different order from the two runs, and so do the answers merged into them
+    return sorted(json.dumps([faq['question'], sorted(answer['answer_text'] for answer in faq['answers'])])
+                  for faq in faqs)
+
+
+def check_incremental_matches_full(before, after):
+    unique_faqs, state = full_run(before)
+    incremental = incremental_run(unique_faqs, state, before + after)
+
+    assert all(faq['answers'] for faq in incremental)
+    assert canonical(incremental) == canonical(full_run(before + after)[0])
+
+
+def test_chat_alone_in_its_faq_gets_an_answer():
+    check_incremental_matches_full([chat('q1', 'a'), chat('q2', 'b'), chat('q3', 'c')], [chat('q1', 'a', 'd')])
+
+
+def test_merged_chat_gets_an_answer():
+    check_incremental_matches_full([chat('q1', 'a'), chat('q1 again', 'b'), chat('q2', 'c')],
+                                   [chat('q1 again', 'b', 'd')])
+
+
+def test_new_chat_joins_a_faq():
+    check_incremental_matches_full([chat('q1', 'a'), chat('q2', 'b')], [chat('q1 again', 'c'), chat('q3', 'd')])
+
+
+def test_chat_loses_its_answers():
+    check_incremental_matches_full([chat('q1', 'a'), chat('q2', 'b'), chat('q3', 'c')], [chat('q2')])
+
+
+def test_incremental_runs_in_a_row():
+    unique_faqs, state = full_run([chat('q1', 'a'), chat('q2', 'b')])
+    unique_faqs = incremental_run(unique_faqs, state, [chat('q1', 'a'), chat('q2', 'b'), chat('q2')])
+    unique_faqs = incremental_run(unique_faqs, state, [chat('q1', 'a'), chat('q2', 'b'), chat('q2'),
+                                                       chat('q2', 'e'), chat('q1', 'a', 'f')])
+
+    assert canonical(unique_faqs) == canonical([chat('q1', 'a', 'f'), chat('q2', 'e')])